@@ -7,6 +7,9 @@ On Windows (or if `sh` is not installed), it falls back to the built-in
 
 Backward compatibility: ``import runps; runps.ls("-la")`` and
 ``from runps import Command`` continue to work via the `pbs` submodule.
+
+Nothing heavy is imported up front: both `sh` and the `pbs` submodule are
+only loaded the first time one of their names is looked up on this package.
 """
 
 # Constants #
@@ -16,32 +19,52 @@ __project_url__ = 'https://github.com/xapple/runps'
 # Built-in modules #
 import sys
 
-# Platform-aware `sh` object #
-if sys.platform == 'win32':
-    from runps import pbs as sh
-else:
+# Names re-exported from pbs for backward compatibility #
+_pbs_exports = ("Command", "CommandNotFound", "ErrorReturnCode",
+                "which", "resolve_program", "glob", "get_rc_exc",
+                "wait", "FIRST_COMPLETED", "FIRST_EXCEPTION", "ALL_COMPLETED",
+                "EnvTemplate", "Cassette", "ReplayError", "record", "replay",
+                "set_limits", "limit_stats", "QueueTimeout", "hedge_stats",
+                "Coprocess", "CoprocessPool", "fanout", "FanoutResult",
+                "Pipeline", "PipelineResult", "PythonPool", "Samples", "SharedOutput")
+
+# Submodules that are imported on first access #
+_submodules = ("pbs", "metrics", "tasks", "parallel", "autotune")
+
+def _load_sh():
+    """Platform-aware `sh` object."""
+    if sys.platform == 'win32':
+        from runps import pbs as sh
+        return sh
     try:
         import sh
-        # After sh v2 the object returned by commands changed.
-        # Baking with _return_cmd=True restores the v1 behavior
-        # where commands return RunningCommand objects.
-        sh_version = int(sh.__version__.split('.')[0])
-        if sh_version > 1:
-            sh = sh.bake(_return_cmd=True)
     except ImportError:
         from runps import pbs as sh
-
-# Re-export pbs internals for backward compatibility #
-from runps.pbs import Command, CommandNotFound, ErrorReturnCode
-from runps.pbs import which, resolve_program, glob, get_rc_exc
-
-# Expose the underlying module for tests that access internals #
-self_module = sys.modules['runps.pbs']
-if hasattr(self_module, 'self_module'):
-    self_module = self_module.self_module
+        return sh
+    # After sh v2 the object returned by commands changed.
+    # Baking with _return_cmd=True restores the v1 behavior
+    # where commands return RunningCommand objects.
+    sh_version = int(sh.__version__.split('.')[0])
+    if sh_version > 1: sh = sh.bake(_return_cmd=True)
+    return sh
 
 def __getattr__(name):
-    """Dynamic command resolution: ``import runps; runps.ls('-la')``."""
-    # Delegate to the pbs module's SelfWrapper for dynamic commands
-    import runps.pbs as _pbs
-    return getattr(_pbs, name)
\ No newline at end of file
+    """Lazy attributes and dynamic command resolution such as
+    ``import runps; runps.ls('-la')``."""
+    if name.startswith("__") and name.endswith("__"):
+        raise AttributeError(name)
+    if name == "sh":
+        value = _load_sh()
+    elif name in _submodules:
+        import importlib
+        return importlib.import_module("runps." + name)
+    else:
+        import runps.pbs as _pbs
+        # Expose the underlying module for tests that access internals #
+        if name == "self_module": value = _pbs.self_module
+        elif name in _pbs_exports: value = getattr(_pbs.self_module, name)
+        # Delegate to the pbs module's SelfWrapper for dynamic commands #
+        else: return getattr(_pbs, name)
+    # Cache so that we only pay once #
+    globals()[name] = value
+    return value
@@ -0,0 +1,186 @@
+"""
+Adaptive concurrency for batches of commands. An Autotuner drives the
+process-wide limit of `runps.set_limits(max_concurrent=...)` between two
+bounds, instead of a fixed number of workers that is too low on an idle host
+and too high on a busy one:
+
+    from runps.autotune import Autotuner
+    with Autotuner(minimum=2, maximum=32, on_decision=print):
+        jobs = [convert(path, _bg=True) for path in paths]
+        runps.wait(jobs)
+
+Every `interval` seconds it looks at the CPU utilization of the host, the
+pressure stall information of `/proc/pressure` (or the load average where
+that's missing) and at how many commands finished. When the host stalls it
+backs off by a quarter. When commands are queuing and the CPUs have room to
+spare it adds one slot, and takes it back if throughput dropped. Each
+change is handed to `on_decision` as a Decision, with the reason and the
+signals that led to it, and kept in `decisions`.
+"""
+
+# Modules #
+import os, time, threading, collections
+
+# Internal modules #
+import runps
+
+# One change of the concurrency limit and why it was made #
+Decision = collections.namedtuple("Decision", ["time", "old", "new", "reason", "signals"])
+
+###############################################################################
+def read_pressure(resource):
+    """The share of time in percent some tasks stalled on `resource` ("cpu",
+    "io" or "memory") over the last ten seconds, or None without PSI."""
+    try:
+        with open("/proc/pressure/" + resource) as handle:
+            for line in handle:
+                if line.startswith("some"):
+                    return float(line.split()[1].split("=")[1])
+    except (OSError, IndexError, ValueError): return None
+
+def read_cpu_times():
+    """The total and idle jiffies of all CPUs, or None without /proc."""
+    try:
+        with open("/proc/stat") as handle: fields = handle.readline().split()[1:]
+    except OSError: return None
+    values = [int(value) for value in fields]
+    # Idle and iowait #
+    return sum(values), values[3] + values[4]
+
+def read_load():
+    """The one minute load average per CPU, or None."""
+    try: return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError): return None
+
+###############################################################################
+class Autotuner(object):
+    """Adjusts the concurrency limit from the load it observes."""
+
+    def __init__(self, minimum=1, maximum=None, start=None, interval=1.0,
+                 target_utilization=0.9, max_pressure=10.0, max_load=1.5,
+                 on_decision=None):
+        cpus = os.cpu_count() or 1
+        self.minimum     = minimum
+        self.maximum     = maximum or 4 * cpus
+        self.concurrency = min(max(start or cpus, minimum), self.maximum)
+        self.interval    = interval
+        self.target_utilization = target_utilization
+        self.max_pressure = max_pressure
+        self.max_load     = max_load
+        self.on_decision  = on_decision
+        self.decisions    = collections.deque(maxlen=1000)
+        self.thread       = None
+        self.previous     = None
+        self.stopped      = threading.Event()
+        # What we saw at the previous step #
+        self.last_cpu        = read_cpu_times()
+        self.last_completed  = self._completed(runps.limit_stats())
+        self.last_time       = time.monotonic()
+        self.probing         = None   # throughput before our last increase
+        self.cooldown        = 0      # steps to wait before probing again
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        self.stop()
+
+    def __repr__(self):
+        return "<Autotuner concurrency=%d [%d, %d]>" % (self.concurrency, self.minimum, self.maximum)
+
+    @staticmethod
+    def _completed(stats):
+        return stats["spawned"] - stats["running"]
+
+    def _apply(self):
+        rate = runps.limit_stats()["max_spawns_per_sec"]
+        runps.set_limits(max_concurrent=self.concurrency, max_spawns_per_sec=rate)
+
+    def start(self):
+        stats = runps.limit_stats()
+        self.previous = stats["max_concurrent"]
+        self._apply()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name="runps-autotune")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop adjusting and put the previous limit back."""
+        self.stopped.set()
+        if self.thread is not None: self.thread.join()
+        self.thread = None
+        rate = runps.limit_stats()["max_spawns_per_sec"]
+        runps.set_limits(max_concurrent=self.previous, max_spawns_per_sec=rate)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval): self.step()
+
+    def measure(self):
+        """The signals the decisions are based on."""
+        now   = time.monotonic()
+        stats = runps.limit_stats()
+        cpu   = read_cpu_times()
+        utilization = None
+        if cpu is not None and self.last_cpu is not None and cpu[0] > self.last_cpu[0]:
+            total, idle = cpu[0] - self.last_cpu[0], cpu[1] - self.last_cpu[1]
+            utilization = 1.0 - idle / float(total)
+        completed = self._completed(stats)
+        elapsed = now - self.last_time
+        throughput = (completed - self.last_completed) / elapsed if elapsed > 0 else 0.0
+        self.last_cpu, self.last_completed, self.last_time = cpu, completed, now
+        return {"utilization":     utilization,
+                "load":            read_load(),
+                "cpu_pressure":    read_pressure("cpu"),
+                "io_pressure":     read_pressure("io"),
+                "memory_pressure": read_pressure("memory"),
+                "throughput":      throughput,
+                "running":         stats["running"],
+                "queued":          stats["queued"]}
+
+    def decide(self, signals):
+        """The new concurrency and the reason for it, given the signals."""
+        current = self.concurrency
+        # Back off when the host stalls #
+        for name in ("cpu_pressure", "io_pressure", "memory_pressure"):
+            value = signals.get(name)
+            if value is not None and value > self.max_pressure:
+                return max(self.minimum, min(current - 1, int(current * 0.75))), \
+                       "%s %.1f%% > %.1f%%" % (name.replace("_", " "), value, self.max_pressure)
+        if signals.get("cpu_pressure") is None:
+            load = signals.get("load")
+            if load is not None and load > self.max_load:
+                return max(self.minimum, min(current - 1, int(current * 0.75))), \
+                       "load %.2f per CPU > %.2f" % (load, self.max_load)
+        # Undo an increase that didn't pay off #
+        throughput = signals.get("throughput")
+        if self.probing is not None and throughput is not None:
+            probing, self.probing = self.probing, None
+            if throughput < probing and current > self.minimum:
+                self.cooldown = 5
+                return current - 1, "throughput %.2f/s fell from %.2f/s" % (throughput, probing)
+        # Add a slot when work is waiting and the CPUs have room #
+        if self.cooldown:
+            self.cooldown -= 1
+            return current, None
+        if not signals.get("queued") or current >= self.maximum: return current, None
+        utilization = signals.get("utilization")
+        if utilization is not None and utilization >= self.target_utilization: return current, None
+        self.probing = throughput
+        if utilization is None: reason = "%d queued" % signals["queued"]
+        else: reason = "utilization %.0f%% < %.0f%% with %d queued" % \
+                       (100 * utilization, 100 * self.target_utilization, signals["queued"])
+        return current + 1, reason
+
+    def step(self, signals=None):
+        """Measure, decide and apply. Returns the Decision or None."""
+        if signals is None: signals = self.measure()
+        new, reason = self.decide(signals)
+        if new == self.concurrency: return None
+        decision = Decision(time.time(), self.concurrency, new, reason, signals)
+        self.concurrency = new
+        if self.thread is not None: self._apply()
+        self.decisions.append(decision)
+        if self.on_decision is not None: self.on_decision(decision)
+        return decision
@@ -0,0 +1,132 @@
+"""
+In-process metrics about the commands run through `runps`: for every
+program (by resolved path) the number of calls, a latency histogram, the
+number of bytes captured and the exit codes seen. It is cheap enough to be
+left on in production. Read it with `snapshot()`, or expose it to
+Prometheus with `exposition()`:
+
+    import runps.metrics
+    print(runps.metrics.exposition())
+"""
+
+# Modules #
+import threading, collections
+
+# Set to False to stop recording #
+enabled = True
+
+# Upper bounds of the latency histogram buckets in seconds #
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))
+
+###############################################################################
+class ProgramStats(object):
+    """Everything we know about one program."""
+
+    __slots__ = ("calls", "seconds", "buckets", "stdout_bytes", "stderr_bytes",
+                 "exit_codes", "errors")
+
+    def __init__(self):
+        self.calls        = 0
+        self.seconds      = 0.0
+        self.buckets      = [0] * len(buckets)
+        self.stdout_bytes = 0
+        self.stderr_bytes = 0
+        self.exit_codes   = collections.Counter()
+        self.errors       = collections.Counter()
+
+    def to_dict(self):
+        return {"calls":        self.calls,
+                "seconds":      self.seconds,
+                "buckets":      dict(zip(buckets, self.buckets)),
+                "stdout_bytes": self.stdout_bytes,
+                "stderr_bytes": self.stderr_bytes,
+                "exit_codes":   dict(self.exit_codes),
+                "errors":       dict(self.errors)}
+
+class Registry(object):
+    """Thread-safe collection of ProgramStats keyed by program path."""
+
+    def __init__(self):
+        self.lock     = threading.Lock()
+        self.programs = {}
+
+    def observe(self, program, seconds, stdout_bytes, stderr_bytes, exit_code, error=None):
+        """Record one finished call, given the number of bytes it printed.
+        `error` is the name of the exception raised for a bad exit code,
+        e.g. "ErrorReturnCode_2"."""
+        index = 0
+        while seconds > buckets[index]: index += 1
+        with self.lock:
+            stats = self.programs.get(program)
+            if stats is None: stats = self.programs[program] = ProgramStats()
+            stats.calls   += 1
+            stats.seconds += seconds
+            stats.buckets[index] += 1
+            stats.stdout_bytes += stdout_bytes
+            stats.stderr_bytes += stderr_bytes
+            stats.exit_codes[exit_code] += 1
+            if error: stats.errors[error] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict((program, stats.to_dict()) for program, stats in self.programs.items())
+
+    def reset(self):
+        with self.lock: self.programs.clear()
+
+    def exposition(self):
+        """The metrics in the Prometheus text exposition format."""
+        lines = []
+        def family(name, kind, text):
+            lines.append("# HELP %s %s" % (name, text))
+            lines.append("# TYPE %s %s" % (name, kind))
+        snapshot = sorted(self.snapshot().items())
+        family("runps_command_calls_total", "counter", "Number of finished calls.")
+        for program, stats in snapshot:
+            lines.append('runps_command_calls_total{program="%s"} %d' % (escape(program), stats["calls"]))
+        family("runps_command_duration_seconds", "histogram", "Wall time of calls.")
+        for program, stats in snapshot:
+            label = escape(program)
+            cumulative = 0
+            for bound in buckets:
+                cumulative += stats["buckets"][bound]
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append('runps_command_duration_seconds_bucket{program="%s",le="%s"} %d' % (label, le, cumulative))
+            lines.append('runps_command_duration_seconds_sum{program="%s"} %r' % (label, stats["seconds"]))
+            lines.append('runps_command_duration_seconds_count{program="%s"} %d' % (label, stats["calls"]))
+        family("runps_command_captured_bytes_total", "counter", "Bytes of output captured.")
+        for program, stats in snapshot:
+            for stream in ("stdout", "stderr"):
+                lines.append('runps_command_captured_bytes_total{program="%s",stream="%s"} %d'
+                             % (escape(program), stream, stats[stream + "_bytes"]))
+        family("runps_command_exit_codes_total", "counter", "Exit codes of calls.")
+        for program, stats in snapshot:
+            for code, count in sorted(stats["exit_codes"].items(), key=lambda item: str(item[0])):
+                lines.append('runps_command_exit_codes_total{program="%s",code="%s"} %d' % (escape(program), code, count))
+        family("runps_command_errors_total", "counter", "ErrorReturnCode exceptions raised.")
+        for program, stats in snapshot:
+            for error, count in sorted(stats["errors"].items()):
+                lines.append('runps_command_errors_total{program="%s",exception="%s"} %d' % (escape(program), error, count))
+        return "\n".join(lines) + "\n"
+
+def escape(value):
+    """Escape a Prometheus label value."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+###############################################################################
+# The default registry used by every command #
+registry = Registry()
+
+def observe(*args, **kwargs):
+    if enabled: registry.observe(*args, **kwargs)
+
+def snapshot():
+    """A dict of per-program statistics, keyed by program path."""
+    return registry.snapshot()
+
+def exposition():
+    """The metrics in the Prometheus text exposition format."""
+    return registry.exposition()
+
+def reset():
+    registry.reset()
@@ -0,0 +1,158 @@
+"""
+Command line runner executing many commands in parallel through `Command`,
+in the spirit of GNU parallel:
+
+    python -m runps.parallel -j 8 --joblog jobs.tsv < commands.txt
+    python -m runps.parallel -j 4 -a files.txt gzip -9 {}
+
+Without a command, every input line is a command of its own. With one, every
+input line is one argument for it, replacing `{}` if present or appended
+otherwise. The output of each job is printed in one piece once it finishes.
+
+The joblog is a tab separated file with one line per finished job, giving
+its sequence number, start time, run time in seconds, exit code, bytes
+written on stdout and command line. With `--resume` the jobs that already
+succeeded according to the joblog are skipped and the others are appended to
+it, so that a batch can be rerun after a partial failure without redoing the
+completed work. The exit status is the number of failed jobs, capped at 101.
+"""
+
+# Modules #
+import sys, os, time, shlex, argparse, collections
+
+# Internal modules #
+import runps
+
+# Columns of the joblog #
+joblog_header = ["Seq", "Starttime", "JobRuntime", "Exitval", "Receive", "Command"]
+
+# A failing exit code is something to log, not an exception #
+all_exit_codes = list(range(256))
+
+###############################################################################
+def read_jobs(lines, command=None):
+    """Turn input lines into the argument vectors of the jobs to run."""
+    jobs = []
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if not line.strip(): continue
+        if not command: argv = shlex.split(line)
+        elif any("{}" in arg for arg in command): argv = [arg.replace("{}", line) for arg in command]
+        else: argv = list(command) + [line]
+        jobs.append(argv)
+    return jobs
+
+def command_line(argv):
+    return " ".join(shlex.quote(arg) for arg in argv)
+
+def succeeded(joblog):
+    """The command lines that the joblog says exited with 0."""
+    if not os.path.exists(joblog): return set()
+    done = set()
+    with open(joblog) as handle:
+        for line in handle:
+            fields = line.rstrip("\n").split("\t", len(joblog_header) - 1)
+            if len(fields) != len(joblog_header) or fields[0] == "Seq": continue
+            if fields[3] == "0": done.add(fields[5])
+    return done
+
+###############################################################################
+class Runner(object):
+    """Runs jobs with at most `workers` of them at once and logs them."""
+
+    def __init__(self, jobs, workers=None, joblog=None, resume=False,
+                 out=None, err=None):
+        self.jobs    = jobs
+        self.workers = workers or os.cpu_count() or 1
+        self.joblog  = joblog
+        self.resume  = resume
+        self.out     = out or sys.stdout
+        self.err     = err or sys.stderr
+        self.failed  = 0
+        self.skipped = 0
+
+    def run(self):
+        """Run every job and return the number of failures."""
+        done = succeeded(self.joblog) if self.joblog and self.resume else set()
+        pending = collections.deque()
+        for seq, argv in enumerate(self.jobs, 1):
+            if command_line(argv) in done: self.skipped += 1
+            else: pending.append((seq, argv))
+        self.log = self._open_log()
+        try:
+            running = {}
+            while pending or running:
+                while pending and len(running) < self.workers:
+                    seq, argv = pending.popleft()
+                    self._start(running, seq, argv)
+                if not running: continue
+                jobs = [entry[-1] for entry in running.values()]
+                finished, not_done = runps.wait(jobs, return_when=runps.FIRST_COMPLETED)
+                for job in finished: self._finish(*running.pop(id(job)))
+        finally:
+            if self.log is not None: self.log.close()
+        return self.failed
+
+    def _open_log(self):
+        if not self.joblog: return None
+        append = self.resume and os.path.exists(self.joblog)
+        handle = open(self.joblog, "a" if append else "w")
+        if not append: handle.write("\t".join(joblog_header) + "\n")
+        return handle
+
+    def _start(self, running, seq, argv):
+        started = time.time()
+        try:
+            command = runps.Command.create(argv[0])
+            job = command(*argv[1:], _bg=True, _ok_code=all_exit_codes)
+        except (runps.CommandNotFound, OSError) as error:
+            if isinstance(error, runps.CommandNotFound): error = "command not found"
+            self.err.write("%s: %s\n" % (argv[0], error))
+            return self._record(seq, argv, started, 0.0, 127, 0)
+        running[id(job)] = (seq, argv, started, time.monotonic(), job)
+
+    def _finish(self, seq, argv, started, clock, job):
+        runtime = time.monotonic() - clock
+        error = job.exception()
+        if error is None: stdout, stderr = job.stdout, job.stderr
+        else:
+            stdout = getattr(error, "stdout", None) or b""
+            stderr = getattr(error, "stderr", None) or str(error).encode()
+            stdout, stderr = stdout.decode("utf8", "replace"), stderr.decode("utf8", "replace")
+        self.out.write(stdout)
+        self.err.write(stderr)
+        self.out.flush()
+        exit_code = job.process.returncode
+        if exit_code is None: exit_code = -1
+        self._record(seq, argv, started, runtime, exit_code, len(stdout.encode("utf8")))
+
+    def _record(self, seq, argv, started, runtime, exit_code, received):
+        if exit_code != 0: self.failed += 1
+        if self.log is None: return
+        fields = [seq, "%.3f" % started, "%.3f" % runtime, exit_code, received, command_line(argv)]
+        self.log.write("\t".join(str(field) for field in fields) + "\n")
+        self.log.flush()
+
+###############################################################################
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m runps.parallel",
+                                     description="Run commands in parallel.")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of jobs to run at once (default: number of CPUs)")
+    parser.add_argument("-a", "--arg-file", default="-",
+                        help="file to read the input lines from (default: stdin)")
+    parser.add_argument("--joblog", help="tab separated log of the finished jobs")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip the jobs that succeeded according to the joblog")
+    parser.add_argument("command", nargs=argparse.REMAINDER,
+                        help="command to run with every input line as argument")
+    options = parser.parse_args(argv)
+    if options.resume and not options.joblog: parser.error("--resume needs --joblog")
+    if options.arg_file == "-": jobs = read_jobs(sys.stdin, options.command)
+    else:
+        with open(options.arg_file) as handle: jobs = read_jobs(handle, options.command)
+    runner = Runner(jobs, options.jobs, options.joblog, options.resume)
+    return min(runner.run(), 101)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,27 @@
 # Modules #
-import sys, os, re, warnings, functools, types, subprocess
+import sys, os, re, warnings, functools, types, subprocess, threading, time, importlib
+import collections, logging, selectors, json, queue, heapq, itertools, array, io, codecs
 from glob import glob as original_glob
+from concurrent import futures
+from concurrent.futures import FIRST_COMPLETED, FIRST_EXCEPTION, ALL_COMPLETED
+
+# Internal modules #
+from runps import metrics
 
 # Python 3 hack #
 IS_PY3 = sys.version_info[0] == 3
 if IS_PY3: unicode = str
 
+# Logger #
+logger = logging.getLogger("runps")
+
 ###############################################################################
 class CommandNotFound(Exception): pass
 
+class ReplayError(Exception): pass
+
+class QueueTimeout(Exception): pass
+
 class ErrorReturnCode(Exception):
     truncate_cap = 200
 
@@ -83,27 +96,791 @@ def resolve_program(program):
 def glob(arg):
     return original_glob(arg) or arg
 
+###############################################################################
+# Notified every time a watched background command finishes #
+_job_condition = threading.Condition()
+
+DoneAndNotDone = collections.namedtuple("DoneAndNotDone", "done not_done")
+
+def wait(jobs, timeout=None, return_when=ALL_COMPLETED):
+    """Block until some or all of the given background commands finish,
+    with the same semantics as `concurrent.futures.wait`. Returns a named
+    tuple of two lists: the jobs that are done and those that are not.
+    These are lists rather than sets because a RunningCommand compares
+    equal to anything with the same output and is therefore not hashable."""
+    # Deduplicate by identity while keeping the order given #
+    jobs = list(dict((id(job), job) for job in jobs).values())
+    # Must happen before we take the condition, `_watch` locks the job #
+    for job in jobs: job._watch()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with _job_condition:
+        while True:
+            done     = [job for job in jobs if job._finished.is_set()]
+            not_done = [job for job in jobs if not job._finished.is_set()]
+            if not not_done: break
+            if return_when == FIRST_COMPLETED and done: break
+            if return_when == FIRST_EXCEPTION:
+                if any(job._exception is not None for job in done): break
+            if deadline is None: _job_condition.wait()
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0: break
+                _job_condition.wait(remaining)
+    return DoneAndNotDone(done, not_done)
+
+###############################################################################
+class _Stream(object):
+    """
+    Hands the stdout of a background child to a consumer iterating over it
+    while it runs, instead of accumulating it. When the consumer lags behind
+    by `depth` chunks the reactor stops reading that pipe, so that the child
+    blocks and memory stays bounded, until the consumer catches up.
+    """
+
+    depth = 16
+
+    def __init__(self):
+        self.queue   = queue.Queue()
+        self.reactor = None
+        self.paused  = None   # the handle we stopped reading from
+        self.collection = None
+
+    def append(self, data):
+        self.queue.put(data)
+
+    def close(self):
+        self.queue.put(None)
+
+    def full(self):
+        return self.queue.qsize() >= self.depth
+
+    def chunks(self):
+        while True:
+            chunk = self.queue.get()
+            if self.paused is not None and self.queue.qsize() < self.depth // 2:
+                self.reactor.resume(self)
+            if chunk is None: return
+            yield chunk
+
+# How to build an incremental compressor for each `_capture_compress` codec #
+capture_codecs = {"zlib": "compressobj", "lzma": "LZMACompressor"}
+
+class _Capture(object):
+    """Accumulates what is read from one pipe of a child."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def append(self, data):
+        self.chunks.append(data)
+
+    def value(self):
+        return b"".join(self.chunks)
+
+class _CompressedCapture(_Capture):
+    """Compresses the output of a child as it is read, see
+    `_capture_compress`. The result is decompressed on access by
+    `RunningCommand`, and its size left on the job for the metrics."""
+
+    def __init__(self, codec, job, stream):
+        _Capture.__init__(self)
+        self.compressor = getattr(importlib.import_module(codec), capture_codecs[codec])()
+        self.job    = job
+        self.stream = stream
+        self.size   = 0
+
+    def append(self, data):
+        self.size += len(data)
+        data = self.compressor.compress(data)
+        if data: self.chunks.append(data)
+
+    def value(self):
+        self.chunks.append(self.compressor.flush())
+        if self.job._raw_sizes is None: self.job._raw_sizes = {}
+        self.job._raw_sizes[self.stream] = self.size
+        return _Capture.value(self)
+
+class _FilteredCapture(object):
+    """Keeps only the lines of stdout accepted by `_filter` as they are
+    read, passing them on to another capture, and counts the others on the
+    job as `dropped_lines`."""
+
+    def __init__(self, keep, capture, job):
+        self.keep    = keep
+        self.capture = capture
+        self.job     = job
+        self.rest    = []    # pieces of a line whose end we haven't read
+        self.dropped = 0
+
+    def append(self, data):
+        end = data.rfind(b"\n") + 1
+        if not end: return self.rest.append(data)
+        self.rest.append(data[:end])
+        lines = b"".join(self.rest).split(b"\n")
+        self.rest = [data[end:]] if end < len(data) else []
+        for line in lines[:-1]: self._offer(line + b"\n")
+
+    def _offer(self, line):
+        if self.keep(line.rstrip(b"\r\n")): self.capture.append(line)
+        else: self.dropped += 1
+
+    def value(self):
+        if self.rest: self._offer(b"".join(self.rest))
+        self.rest = []
+        self.job._dropped = self.dropped
+        return self.capture.value()
+
+def _line_filter(pattern):
+    """Turn a `_filter` regex or callable into a test on a line of bytes.
+    Callables and text patterns see the line decoded, without its end."""
+    if isinstance(pattern, (str, bytes)): pattern = re.compile(pattern)
+    if not hasattr(pattern, "search"):
+        return lambda line: pattern(line.decode("utf8", "replace"))
+    if isinstance(pattern.pattern, bytes): return pattern.search
+    return lambda line: pattern.search(line.decode("utf8", "replace"))
+
+def _capture(job, stream):
+    """The object that accumulates the "out" or "err" stream of a job."""
+    codec = job.call_args["capture_compress"]
+    if codec is None: capture = _Capture()
+    else:             capture = _CompressedCapture(codec, job, stream)
+    pattern = job.call_args["filter"]
+    if pattern is None or stream != "out": return capture
+    return _FilteredCapture(_line_filter(pattern), capture, job)
+
+def _captured(job, stream, data):
+    """Run output that was read in one go through the capture stage."""
+    if data is None: return None
+    capture = _capture(job, stream)
+    capture.append(data)
+    return capture.value()
+
+class _Collection(object):
+    """The pipes and exit status of one child that the reactor is following."""
+
+    def __init__(self, job):
+        self.job     = job
+        self.process = job.process
+        self.out     = None
+        self.err     = None
+        if self.process.stdout: self.out = job._stream or _capture(job, "out")
+        if self.process.stderr: self.err = _capture(job, "err")
+        self.input   = memoryview(job._input or b"")
+        self.handles = []
+        self.pidfd   = None
+        self.exited  = False
+
+class _Reactor(object):
+    """
+    A single daemon thread that multiplexes the pipes and the exits of every
+    watched background child with `selectors`, instead of one thread per
+    child. Exits are noticed through a `pidfd` where the kernel supports it
+    (Linux 5.3 and Python 3.9 onwards). Elsewhere we don't touch the
+    process-wide SIGCHLD handler, which belongs to the application: a child
+    that has closed its pipes but not exited yet is checked on a short tick
+    instead. In practice this only costs a few wake-ups, as children tend
+    to exit right after closing their output.
+    """
+
+    chunk_size = 65536
+    tick       = 0.05
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock     = threading.Lock()
+        self.incoming = []
+        self.resumed  = []      # streams whose consumer caught up
+        self.exits    = []      # (process, callback) to register
+        self.orphans  = set()   # collections with no pidfd and no pipes left
+        self.polled   = []      # exit watches without a pidfd
+        # Self-pipe used to wake up the select call #
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_r, False)
+        os.set_blocking(self.wake_w, False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ, None)
+        self.thread = threading.Thread(target=self._run, name="runps-reactor")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, job):
+        with self.lock: self.incoming.append(job)
+        self._wake()
+
+    def on_exit(self, process, callback):
+        """Call `callback` from the reactor thread once `process` has
+        exited, without touching its pipes."""
+        with self.lock: self.exits.append((process, callback))
+        self._wake()
+
+    def resume(self, stream):
+        with self.lock: self.resumed.append(stream)
+        self._wake()
+
+    def _wake(self):
+        try: os.write(self.wake_w, b"\0")
+        except BlockingIOError: pass
+
+    def _run(self):
+        while True:
+            timeout = self.tick if self.orphans or self.polled else None
+            for key, mask in self.selector.select(timeout):
+                if key.data is None:
+                    try:
+                        while os.read(self.wake_r, 4096): pass
+                    except BlockingIOError: pass
+                    continue
+                collection, target = key.data
+                if target == "notify":
+                    self.selector.unregister(key.fileobj)
+                    os.close(key.fileobj)
+                    self._notify(collection)
+                    continue
+                try:
+                    if target == "exit": self._exited(collection)
+                    elif target is None: self._write(collection, key.fileobj)
+                    else: self._read(collection, key.fileobj, target)
+                except Exception as exception:
+                    self._abort(collection, exception)
+            with self.lock:
+                incoming, self.incoming = self.incoming, []
+                resumed,  self.resumed  = self.resumed,  []
+                exits,    self.exits    = self.exits,    []
+            for watch in exits:
+                try: pidfd = os.pidfd_open(watch[0].pid)
+                except (AttributeError, OSError): self.polled.append(watch)
+                else: self.selector.register(pidfd, selectors.EVENT_READ, (watch, "notify"))
+            for watch in list(self.polled):
+                if watch[0].poll() is None: continue
+                self.polled.remove(watch)
+                self._notify(watch)
+            for stream in resumed:
+                if stream.paused is None: continue
+                handle, stream.paused = stream.paused, None
+                self.selector.register(handle, selectors.EVENT_READ, (stream.collection, stream))
+            for job in incoming:
+                collection = _Collection(job)
+                if isinstance(collection.out, _Stream): collection.out.collection = collection
+                try: self._register(collection)
+                except Exception as exception: self._abort(collection, exception)
+            for collection in list(self.orphans):
+                try: self._finish(collection)
+                except Exception as exception: self._abort(collection, exception)
+
+    def _register(self, collection):
+        process = collection.process
+        for handle, chunks in ((process.stdout, collection.out),
+                               (process.stderr, collection.err)):
+            if handle is None: continue
+            self.selector.register(handle, selectors.EVENT_READ, (collection, chunks))
+            collection.handles.append(handle)
+        if process.stdin:
+            if collection.input:
+                os.set_blocking(process.stdin.fileno(), False)
+                self.selector.register(process.stdin, selectors.EVENT_WRITE, (collection, None))
+                collection.handles.append(process.stdin)
+            else: process.stdin.close()
+        try: collection.pidfd = os.pidfd_open(process.pid)
+        except (AttributeError, OSError): pass
+        else: self.selector.register(collection.pidfd, selectors.EVENT_READ, (collection, "exit"))
+        self._finish(collection)
+
+    def _read(self, collection, handle, chunks):
+        data = os.read(handle.fileno(), self.chunk_size)
+        if data:
+            chunks.append(data)
+            if isinstance(chunks, _Stream) and chunks.full():
+                self.selector.unregister(handle)
+                chunks.reactor, chunks.paused = self, handle
+            return
+        if isinstance(chunks, _Stream): chunks.close()
+        self._close(collection, handle)
+        self._finish(collection)
+
+    def _write(self, collection, handle):
+        try:
+            written = os.write(handle.fileno(), collection.input[:self.chunk_size])
+            collection.input = collection.input[written:]
+        except BrokenPipeError: collection.input = collection.input[:0]
+        if collection.input: return
+        self._close(collection, handle)
+        self._finish(collection)
+
+    def _notify(self, watch):
+        process, callback = watch
+        try: callback()
+        except Exception: logger.exception("Exception in exit callback for %r", process)
+
+    def _exited(self, collection):
+        self.selector.unregister(collection.pidfd)
+        os.close(collection.pidfd)
+        collection.pidfd  = None
+        collection.exited = True
+        self._finish(collection)
+
+    def _close(self, collection, handle):
+        collection.handles.remove(handle)
+        try: self.selector.unregister(handle)
+        except KeyError: pass   # a paused stream
+        try: handle.close()
+        except BrokenPipeError: pass
+
+    def _finish(self, collection):
+        """Resolve the job once all its pipes are closed and it has exited."""
+        if collection.handles: return
+        if not collection.exited and collection.pidfd is None:
+            collection.exited = collection.process.poll() is not None
+            if not collection.exited: return self.orphans.add(collection)
+        if not collection.exited: return
+        self.orphans.discard(collection)
+        out, err = collection.out, collection.err
+        # Streamed output went to the consumer, we didn't keep it #
+        if isinstance(out, _Stream): out = b""
+        elif out is not None: out = out.value()
+        if err is not None: err = err.value()
+        collection.job._resolve(out, err)
+
+    def _abort(self, collection, exception):
+        """Forget everything about a collection that failed unexpectedly so
+        that its descriptors don't keep the selector spinning."""
+        self.orphans.discard(collection)
+        if isinstance(collection.out, _Stream): collection.out.close()
+        for handle in list(collection.handles):
+            try: self._close(collection, handle)
+            except Exception: pass
+        if collection.pidfd is not None:
+            try: self.selector.unregister(collection.pidfd)
+            except Exception: pass
+            os.close(collection.pidfd)
+            collection.pidfd = None
+        collection.job._resolve(exception=exception)
+
+_reactor = None
+_reactor_lock = threading.Lock()
+
+def _get_reactor():
+    global _reactor
+    with _reactor_lock:
+        if _reactor is None: _reactor = _Reactor()
+        return _reactor
+
+def _on_exit(process, callback):
+    """Call `callback` once `process` has exited."""
+    if os.name != "nt": return _get_reactor().on_exit(process, callback)
+    def target():
+        process.wait()
+        callback()
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+
+###############################################################################
+class _Limiter(object):
+    """
+    Process-wide cap on the number of children running at once and on the
+    rate at which they are spawned. Callers queue by priority (lower first,
+    then in arrival order) and give up with QueueTimeout after their
+    `_queue_timeout`. Configured with `set_limits` and inspected with
+    `limit_stats`.
+    """
+
+    priorities = {"high": 0, "normal": 1, "low": 2}
+
+    def __init__(self):
+        self.condition      = threading.Condition()
+        self.max_concurrent = None
+        self.rate           = None
+        self.running        = 0
+        self.waiting        = []   # heap of (priority, sequence) tickets
+        self.sequence       = itertools.count()
+        self.next_spawn     = 0.0
+        self.stats          = collections.Counter()
+        self.local          = threading.local()   # slots reserved by a thread
+
+    @property
+    def active(self):
+        return self.max_concurrent is not None or self.rate is not None
+
+    def configure(self, max_concurrent, max_spawns_per_sec):
+        with self.condition:
+            self.max_concurrent = max_concurrent
+            self.rate = max_spawns_per_sec
+            self.condition.notify_all()
+
+    def acquire(self, priority="normal", timeout=None, count=1):
+        """Block until we may spawn a child, or `count` of them. Returns
+        whether the slots were taken, which then have to be given back with
+        `release`. More slots than the limit are taken once nothing runs."""
+        if getattr(self.local, "reserved", 0):
+            self.local.reserved -= 1
+            return True
+        if not self.active: return False
+        priority = self.priorities.get(priority, priority)
+        ticket = (priority, next(self.sequence))
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        with self.condition:
+            heapq.heappush(self.waiting, ticket)
+            self.stats["max_queued"] = max(self.stats["max_queued"], len(self.waiting))
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = None
+                    if self.waiting[0] == ticket:
+                        full = self.max_concurrent is not None and \
+                               self.running + count > self.max_concurrent and \
+                               (self.running > 0 or count == 1)
+                        if not full:
+                            delay = self.next_spawn - now if self.rate else 0
+                            if delay <= 0: break
+                    if deadline is not None:
+                        if now >= deadline:
+                            self.stats["timeouts"] += 1
+                            raise QueueTimeout("Waited %.3fs for a slot to spawn a process." % timeout)
+                        delay = deadline - now if delay is None else min(delay, deadline - now)
+                    self.condition.wait(delay)
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                # The next in line might be able to go now #
+                self.condition.notify_all()
+            self.running += count
+            if self.rate: self.next_spawn = max(now, self.next_spawn) + float(count) / self.rate
+            waited = time.monotonic() - start
+            self.stats["spawned"] += count
+            self.stats["total_wait"] += waited
+            self.stats["max_wait"] = max(self.stats["max_wait"], waited)
+        return True
+
+    def release(self, count=1):
+        with self.condition:
+            self.running -= count
+            self.condition.notify_all()
+
+    def reserve(self, count, priority="normal", timeout=None):
+        """Take `count` slots at once for commands that only make progress
+        together, like the stages of a pipeline, which could otherwise each
+        hold a slot while waiting for the next one. The next `count` calls
+        to `acquire` from this thread get them without queuing again."""
+        self.local.reserved = count if self.acquire(priority, timeout, count) else 0
+
+    def unreserve(self):
+        """Give back the reserved slots that weren't used."""
+        left, self.local.reserved = getattr(self.local, "reserved", 0), 0
+        if left: self.release(left)
+
+    def snapshot(self):
+        with self.condition:
+            result = dict.fromkeys(("spawned", "timeouts", "max_queued", "total_wait", "max_wait"), 0)
+            result.update(self.stats)
+            result.update(running=self.running, queued=len(self.waiting),
+                          max_concurrent=self.max_concurrent,
+                          max_spawns_per_sec=self.rate)
+            return result
+
+_limiter = _Limiter()
+
+def set_limits(max_concurrent=None, max_spawns_per_sec=None):
+    """Limit how many commands run at once and how fast they are spawned,
+    for the whole process. None means unlimited. Commands that can't start
+    yet wait in a queue ordered by their `_priority` ("high", "normal",
+    "low" or a number, lower goes first), for at most `_queue_timeout`
+    seconds after which QueueTimeout is raised."""
+    _limiter.configure(max_concurrent, max_spawns_per_sec)
+
+def limit_stats():
+    """Counters of the limiter: running children, queue depth and its
+    maximum, spawns, timeouts and the total and maximum queue wait."""
+    return _limiter.snapshot()
+
+###############################################################################
+# Counters and recent latencies of calls made with `_hedge_after` #
+_hedge_lock      = threading.Lock()
+_hedge_counts    = collections.Counter()
+_hedge_latencies = {}   # program path -> deque of seconds
+
+def hedge_stats():
+    """Counters of `_hedge_after`: calls made with it, duplicates launched
+    because the first run was slow, and duplicates that finished first."""
+    with _hedge_lock:
+        result = dict.fromkeys(("calls", "fired", "won"), 0)
+        result.update(_hedge_counts)
+        return result
+
+def _hedge_delay(program, hedge_after):
+    """Seconds to wait before launching a duplicate, None for never."""
+    if hedge_after != "p95": return hedge_after
+    with _hedge_lock: seen = sorted(_hedge_latencies.get(program, ()))
+    # Don't guess before we have seen enough calls #
+    if len(seen) < 20: return None
+    return seen[int(0.95 * (len(seen) - 1))]
+
+# Calls made with `_coalesce` that are still running, by what they run #
+_flights_lock = threading.Lock()
+_flights      = {}   # key -> Future of the RunningCommand
+
+###############################################################################
+def _numpy(use_numpy=None):
+    """NumPy, which is optional, or None. With `use_numpy` True it must be
+    installed, with False it's never used."""
+    if use_numpy is False: return None
+    try: import numpy
+    except ImportError:
+        if use_numpy: raise
+        return None
+    return numpy
+
+def _parse_numbers(data, dtype, columns, sep, use_numpy):
+    """Parse the numbers separated by whitespace or `sep` in raw bytes into
+    an array. When `columns` is a sequence, return one array per column."""
+    numpy = _numpy(use_numpy)
+    if isinstance(sep, str): sep = sep.encode()
+    if columns is None:
+        if numpy is not None:
+            if sep is not None: data = data.replace(sep, b" ")
+            return numpy.fromstring(data, dtype=dtype, sep=" ")
+        if sep is not None: data = data.replace(b"\n", sep)
+        convert = float if dtype in ("f", "d") else int
+        return array.array(dtype, [convert(token) for token in data.split(sep) if token.strip()])
+    indices = [columns] if isinstance(columns, int) else list(columns)
+    if numpy is not None:
+        if not data.strip(): found = [numpy.empty(0, dtype) for index in indices]
+        else:
+            delimiter = None if sep is None else sep.decode()
+            table = numpy.loadtxt(io.BytesIO(data), dtype=dtype, delimiter=delimiter,
+                                  usecols=indices, ndmin=2)
+            found = list(table.T)
+    else:
+        convert = float if dtype in ("f", "d") else int
+        rows = [line.split(sep) for line in data.splitlines() if line.strip()]
+        found = [array.array(dtype, [convert(row[index]) for row in rows]) for index in indices]
+    if isinstance(columns, int): return found[0]
+    return tuple(found)
+
+def _zombie_cpu_times(pid):
+    """The user and system CPU seconds of a child that has exited but that
+    wasn't reaped yet, read from /proc. None where that isn't possible."""
+    try:
+        with open("/proc/%d/stat" % pid, "rb") as handle: stat = handle.read()
+    except OSError: return None
+    # The fields after the command name, which may contain anything #
+    fields = stat[stat.rfind(b")") + 2:].split()
+    ticks  = os.sysconf("SC_CLK_TCK")
+    return int(fields[11]) / ticks, int(fields[12]) / ticks
+
+###############################################################################
+class Samples(object):
+    """
+    The time series recorded for a child with `_sample_interval`, kept in
+    compact arrays: seconds since the start, CPU usage in percent of one
+    core, resident memory and bytes read from and written to storage so far.
+    Iterating gives one (time, cpu, rss, read, write) tuple per sample.
+    """
+
+    __slots__ = ("time", "cpu", "rss", "read", "write", "__weakref__")
+
+    def __init__(self):
+        self.time  = array.array("d")
+        self.cpu   = array.array("f")
+        self.rss   = array.array("q")
+        self.read  = array.array("q")
+        self.write = array.array("q")
+
+    def __len__(self):
+        return len(self.time)
+
+    def __iter__(self):
+        return zip(self.time, self.cpu, self.rss, self.read, self.write)
+
+    def __repr__(self):
+        return "<Samples count=%d peak_rss=%d>" % (len(self), self.peak_rss)
+
+    @property
+    def peak_rss(self):
+        return max(self.rss) if self.rss else 0
+
+def _proc_stat(pid):
+    """The state, parent, CPU ticks and resident pages of a process."""
+    with open("/proc/%d/stat" % pid, "rb") as handle: stat = handle.read()
+    fields = stat[stat.rfind(b")") + 2:].split()
+    return fields[0], int(fields[1]), int(fields[11]) + int(fields[12]), int(fields[21])
+
+def _proc_io(pid):
+    """The bytes a process read from and wrote to storage, 0 if unknown."""
+    read = write = 0
+    try:
+        with open("/proc/%d/io" % pid, "rb") as handle:
+            for line in handle:
+                if line.startswith(b"read_bytes:"):    read  = int(line.split()[1])
+                elif line.startswith(b"write_bytes:"): write = int(line.split()[1])
+    except OSError: pass
+    return read, write
+
+def _descendants(pid):
+    """The pids of all the processes below `pid`."""
+    children = collections.defaultdict(list)
+    for name in os.listdir("/proc"):
+        if not name.isdigit(): continue
+        try: parent = _proc_stat(int(name))[1]
+        except (OSError, IndexError, ValueError): continue
+        children[parent].append(int(name))
+    found, pending = [], [pid]
+    while pending:
+        below = children.get(pending.pop(), [])
+        found.extend(below)
+        pending.extend(below)
+    return found
+
+class _Sampler(object):
+    """
+    A single daemon thread reading /proc for every child started with
+    `_sample_interval`, each at its own pace, until it exits. The
+    descendants of the child are included with `_sample_children`.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.heap      = []
+        self.sequence  = itertools.count()
+        self.ticks     = os.sysconf("SC_CLK_TCK")
+        self.page_size = os.sysconf("SC_PAGE_SIZE")
+        self.thread = threading.Thread(target=self._run, name="runps-sampler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, process, interval, children=False):
+        samples = Samples()
+        entry = [process, interval, children, samples, time.monotonic(), {}]
+        with self.condition:
+            heapq.heappush(self.heap, (time.monotonic(), next(self.sequence), entry))
+            self.condition.notify()
+        return samples
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.heap: self.condition.wait()
+                due, sequence, entry = self.heap[0]
+                delay = due - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                heapq.heappop(self.heap)
+            try: alive = self._sample(entry)
+            except Exception:
+                logger.exception("Exception while sampling %r", entry[0])
+                alive = False
+            if not alive: continue
+            with self.condition:
+                heapq.heappush(self.heap, (due + entry[1], next(self.sequence), entry))
+
+    def _sample(self, entry):
+        """Record one sample, return whether the child is still running."""
+        process, interval, children, samples, started, previous = entry
+        if process.returncode is not None: return False
+        now = time.monotonic()
+        try: state, parent, ticks, pages = _proc_stat(process.pid)
+        except (OSError, IndexError, ValueError): return False
+        if state == b"Z": return False
+        pids = [process.pid] + (_descendants(process.pid) if children else [])
+        current, rss, read, write = {}, 0, 0, 0
+        for pid in pids:
+            try:
+                if pid == process.pid: pid_ticks, pid_pages = ticks, pages
+                else: pid_ticks, pid_pages = _proc_stat(pid)[2:]
+            except (OSError, IndexError, ValueError): continue
+            current[pid] = pid_ticks
+            rss += pid_pages * self.page_size
+            pid_read, pid_write = _proc_io(pid)
+            read, write = read + pid_read, write + pid_write
+        # Only count processes seen last time, others would make it jump #
+        cpu = 0.0
+        if samples.time:
+            spent = sum(current[pid] - previous[pid] for pid in current if pid in previous)
+            elapsed = now - started - samples.time[-1]
+            if elapsed > 0: cpu = 100.0 * spent / self.ticks / elapsed
+        entry[5] = current
+        samples.time.append(now - started)
+        samples.cpu.append(cpu)
+        samples.rss.append(rss)
+        samples.read.append(read)
+        samples.write.append(write)
+        return True
+
+_sampler = None
+
+def _get_sampler():
+    global _sampler
+    with _reactor_lock:
+        if _sampler is None: _sampler = _Sampler()
+        return _sampler
+
 ###############################################################################
 class RunningCommand(object):
-    def __init__(self, command_ran, process, call_args, stdin=None):
+    # Results are often kept around by the thousand, skip the __dict__ #
+    __slots__ = ("command_ran", "process", "call_args", "_program", "_started",
+                 "_stdout", "_stderr", "_stream", "_lock", "_finished",
+                 "_exception", "_callbacks", "_watcher", "_input", "_dropped",
+                 "_ended", "_cpu_times", "_samples", "_piped", "_raw_sizes", "_abandoned",
+                 "__weakref__")
+
+    def __init__(self, command_ran, process, call_args, stdin=None,
+                 program=None, started=None):
         # Base attributes #
         self.command_ran = command_ran
         self.process = process
+        self._program = program
+        self._started = started
         self._stdout = None
         self._stderr = None
+        self._dropped = 0
+        self._ended = None
+        self._cpu_times = None
+        self._samples = None
+        self._piped = False
+        self._raw_sizes = None
+        self._abandoned = False
         self.call_args = call_args
 
+        # Follow the resources used by the child while it runs #
+        interval = call_args["sample_interval"]
+        if interval and process is not None and os.path.isdir("/proc"):
+            self._samples = _get_sampler().add(process, interval, call_args["sample_children"])
+
+        # Future protocol state #
+        self._stream    = None
+        self._lock      = threading.Lock()
+        self._finished  = threading.Event()
+        self._exception = None
+        self._callbacks = []
+        self._watcher   = None
+
+        # Encode whatever we'll feed on stdin #
+        if stdin: stdin = stdin.encode("utf8")
+        self._input = stdin
+
         # We're running in the background, return self and let us lazily
-        # evaluate.
-        if self.call_args["bg"]: return
+        # evaluate. The metrics still want to know when it exited.
+        if self.call_args["bg"]:
+            if program is not None and metrics.enabled: _on_exit(process, self._exited)
+            return
 
         # We're running this command as a with context, don't do anything
         # because nothing was started to run from Command.__call__
-        if self.call_args["with"]: return
+        if self.call_args["with"]:
+            self._finished.set()
+            return
+
+        # Compress or filter the output while reading it, through the reactor #
+        transformed = self.call_args["capture_compress"] or self.call_args["filter"] is not None
+        if transformed and os.name != "nt":
+            if not isinstance(self.process, _ReplayedProcess): return self._wait()
 
         # Run and block #
-        if stdin: stdin = stdin.encode("utf8")
-        self._stdout, self._stderr = self.process.communicate(stdin)
+        stdout, stderr = self.process.communicate(stdin)
+        self._ended = time.monotonic()
+        self._stdout = _captured(self, "out", stdout)
+        self._stderr = _captured(self, "err", stderr)
+        self._finished.set()
         self._handle_exit_code(self.process.wait())
 
     def __enter__(self):
@@ -127,7 +904,7 @@ class RunningCommand(object):
 
     def __unicode__(self):
         if self.process:
-            if self.call_args["bg"]: self.wait()
+            if self.call_args["bg"]: self._wait()
             if self._stdout: return self.stdout
             else: return ""
 
@@ -155,34 +932,629 @@ class RunningCommand(object):
 
     @property
     def stdout(self):
-        if self.call_args["bg"]: self.wait()
-        return self._stdout.decode("utf8", "replace")
+        if self.call_args["bg"]: self._wait()
+        if self._stdout is None: return ""
+        return self._decompress(self._stdout).decode("utf8", "replace")
 
     @property
     def stderr(self):
-        if self.call_args["bg"]: self.wait()
-        return self._stderr.decode("utf8", "replace")
+        if self.call_args["bg"]: self._wait()
+        if self._stderr is None: return ""
+        return self._decompress(self._stderr).decode("utf8", "replace")
+
+    def _decompress(self, data):
+        """The raw bytes of captured output kept with `_capture_compress`."""
+        codec = self.call_args["capture_compress"]
+        if not data or codec is None: return data
+        return importlib.import_module(codec).decompress(data)
+
+    def share(self):
+        """Copy the output into a shared memory segment and return a small
+        picklable SharedOutput handle to it, that another process can read
+        without copying. See SharedOutput for who frees the segment."""
+        if self.call_args["bg"]: self._wait()
+        return SharedOutput.create(self.command_ran, self.process.returncode,
+                                   self._decompress(self._stdout) or b"",
+                                   self._decompress(self._stderr) or b"")
+
+    @property
+    def samples(self):
+        """The Samples recorded with `_sample_interval`, or None."""
+        return self._samples
+
+    @property
+    def dropped_lines(self):
+        """How many lines of stdout `_filter` left out."""
+        if self.call_args["bg"]: self._wait()
+        return self._dropped
 
     @property
     def ran(self):
         return self.command_ran
 
+    def json(self, **kwargs):
+        """Parse the output as a JSON document, straight from the bytes."""
+        if self.call_args["bg"]: self._wait()
+        if self._stdout is None:
+            where = "the terminal" if self.call_args["fg"] else "'%s'" % self.call_args["out"]
+            raise ValueError("No output to parse, stdout of %r was redirected to %s."
+                             % (self.ran, where))
+        return json.loads(self._decompress(self._stdout), **kwargs)
+
+    def to_array(self, dtype="d", columns=None, sep=None, use_numpy=None):
+        """Parse numeric output straight from the bytes into an `array.array`
+        of typecode `dtype`, or a NumPy array when it is installed. Values
+        are separated by whitespace or by `sep`. Pass a column number, or a
+        sequence of them to get a tuple of arrays, to pick out columns of
+        each line."""
+        if self.call_args["bg"]: self._wait()
+        data = self._decompress(self._stdout) or b""
+        return _parse_numbers(data, dtype, columns, sep, use_numpy)
+
+    def iter_arrays(self, dtype="d", columns=None, sep=None, use_numpy=None, lines=65536):
+        """Like `to_array`, but yield one array (or tuple of arrays) for
+        every `lines` lines, while a background child is still running."""
+        batch = []
+        for line in self._iter_lines():
+            batch.append(line)
+            if len(batch) < lines: continue
+            yield _parse_numbers(b"".join(batch), dtype, columns, sep, use_numpy)
+            batch = []
+        if batch: yield _parse_numbers(b"".join(batch), dtype, columns, sep, use_numpy)
+
+    def iter_json(self, **kwargs):
+        """Parse the output as newline-delimited JSON, one object per line.
+        On a background command that wasn't collected yet, the objects are
+        yielded as the child produces them and the output isn't retained."""
+        for line in self._iter_lines():
+            if line.strip(): yield json.loads(line, **kwargs)
+
+    def _iter_lines(self):
+        """Yield the lines of stdout, while the child runs if possible."""
+        stream = None
+        with self._lock:
+            if self._watcher is None and not self._finished.is_set():
+                if os.name != "nt" and self.process.stdout:
+                    stream = self._stream = _Stream()
+        if stream is None:
+            self._wait()
+            for line in (self._decompress(self._stdout) or b"").splitlines(True): yield line
+            return
+        self._watch()
+        rest = b""
+        for chunk in stream.chunks():
+            lines = (rest + chunk).split(b"\n")
+            rest = lines.pop()
+            for line in lines: yield line + b"\n"
+        if rest: yield rest
+        # Raise if the exit code is not an acceptable one #
+        self._wait()
+
     def wait(self):
-        if self.process.returncode is not None: return
-        self._stdout, self._stderr = self.process.communicate()
-        self._handle_exit_code(self.process.wait())
+        self._wait()
         return str(self)
 
+    def _wait(self):
+        self._watch()
+        self._finished.wait()
+        if self._exception is not None: raise self._exception
+
+    def _collect(self):
+        """Drain the pipes of the child with `communicate` and resolve."""
+        try: stdout, stderr = self.process.communicate(self._input)
+        except Exception as exception: self._resolve(exception=exception)
+        else: self._resolve(_captured(self, "out", stdout), _captured(self, "err", stderr))
+
+    def _resolve(self, stdout=None, stderr=None, exception=None):
+        """Reap the child, check its exit code and resolve the future.
+        Only the first call has any effect."""
+        if self._finished.is_set(): return
+        if self._ended is None: self._ended = time.monotonic()
+        if exception is None:
+            if self.call_args["cpu_times"] and self.process.returncode is None:
+                self._cpu_times = _zombie_cpu_times(self.process.pid)
+            self._stdout, self._stderr = stdout, stderr
+            # Killed on purpose, nothing to check nor count #
+            if self._abandoned: self.process.wait()
+            else:
+                try: self._handle_exit_code(self.process.wait())
+                except Exception as error: exception = error
+        with self._lock:
+            if self._finished.is_set(): return
+            self._exception = exception
+            self._finished.set()
+            callbacks = list(self._callbacks)
+        # Never hold the job lock while notifying, `wait` nests them the
+        # other way around.
+        with _job_condition: _job_condition.notify_all()
+        for callback in callbacks:
+            try: callback(self)
+            except Exception:
+                logger.exception("Exception in callback %r for %r", callback, self)
+
+    def _watch(self, unclaimed=False):
+        """Hand a background command over to the reactor (or, on Windows
+        where pipes can't be selected, to a helper thread) so that we get
+        notified as soon as it exits. With `unclaimed` only if nobody is
+        streaming its output or piping it into another command."""
+        with self._lock:
+            if self._watcher is not None or self._finished.is_set(): return
+            if unclaimed and (self._piped or self._stream is not None): return
+            if os.name == "nt":
+                self._watcher = threading.Thread(target=self._collect)
+                self._watcher.daemon = True
+                self._watcher.start()
+            else:
+                self._watcher = _get_reactor()
+                self._watcher.add(self)
+
+    def _exited(self):
+        """The child of a background command exited: note when, and collect
+        it even if nobody ever waits for it, so that it's in the metrics."""
+        if self._ended is None: self._ended = time.monotonic()
+        self._watch(unclaimed=True)
+
     def _handle_exit_code(self, rc):
-        if rc not in self.call_args["ok_code"]:
-            raise get_rc_exc(rc)(self.command_ran, self._stdout, self._stderr, self.call_args)
+        error = rc not in self.call_args["ok_code"]
+        observe = self._program is not None and metrics.enabled
+        if observe:
+            seconds = (self._ended or time.monotonic()) - self._started
+            name = "ErrorReturnCode_%d" % rc if error else None
+            metrics.observe(self._program, seconds, self._raw_size("out", self._stdout),
+                            self._raw_size("err", self._stderr), rc, name)
+        if error:
+            stdout, stderr = self._decompress(self._stdout), self._decompress(self._stderr)
+            raise get_rc_exc(rc)(self.command_ran, stdout, stderr, self.call_args)
+
+    def _raw_size(self, stream, data):
+        """The length of captured output, without decompressing it."""
+        if not data: return 0
+        if self.call_args["capture_compress"] is None: return len(data)
+        size = (self._raw_sizes or {}).get(stream)
+        if size is None: size = len(self._decompress(data))
+        return size
+
+    # Future protocol #
+    def done(self):
+        self._watch()
+        return self._finished.is_set()
+
+    def running(self):
+        return not self.done()
+
+    def cancel(self):
+        # Like a running `concurrent.futures.Future`, we cannot be cancelled #
+        return False
+
+    def cancelled(self):
+        return False
+
+    def result(self, timeout=None):
+        self._watch()
+        if not self._finished.wait(timeout): raise futures.TimeoutError()
+        if self._exception is not None: raise self._exception
+        return self
+
+    def exception(self, timeout=None):
+        self._watch()
+        if not self._finished.wait(timeout): raise futures.TimeoutError()
+        return self._exception
+
+    def add_done_callback(self, fn):
+        with self._lock:
+            if not self._finished.is_set():
+                self._callbacks.append(fn)
+                fn = None
+        if fn is not None: fn(self)
+        else: self._watch()
 
     def __len__(self):
         return len(str(self))
 
 ###############################################################################
+def _shared_memory(name=None, size=0):
+    """Create (without a name) or map a segment that no process is made
+    responsible for: before Python 3.13, both register it with the resource
+    tracker, which would free it as soon as the worker that made it exits."""
+    from multiprocessing import shared_memory
+    create = name is None
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, create, size, track=False)
+    segment = shared_memory.SharedMemory(name, create, size)
+    if os.name != "nt":
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
+class SharedOutput(object):
+    """
+    The output of a finished command, placed in a `multiprocessing`
+    shared memory segment by `RunningCommand.share()`. Pickling it only
+    sends the name of the segment, so returning it from a worker process is
+    cheap. On the other side, `stdout_view` and `stderr_view` are read-only
+    memoryviews of the segment, while `stdout` and `stderr` decode it like
+    on a RunningCommand. Whoever is done with it last calls `release()` to
+    free the segment, or uses it as a context manager.
+    """
+
+    def __init__(self, name, command_ran, exit_code, stdout_size, stderr_size):
+        self.name        = name
+        self.command_ran = command_ran
+        self.exit_code   = exit_code
+        self.stdout_size = stdout_size
+        self.stderr_size = stderr_size
+        self._segment    = None
+
+    @classmethod
+    def create(cls, command_ran, exit_code, stdout, stderr):
+        segment = _shared_memory(size=max(1, len(stdout) + len(stderr)))
+        segment.buf[:len(stdout)] = stdout
+        segment.buf[len(stdout):len(stdout) + len(stderr)] = stderr
+        shared = cls(segment.name, command_ran, exit_code, len(stdout), len(stderr))
+        shared._segment = segment
+        return shared
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_segment"] = None
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        self.release()
+
+    def __repr__(self):
+        return "<SharedOutput %r of %r, %d+%d bytes>" % (
+            self.name, self.command_ran, self.stdout_size, self.stderr_size)
+
+    def __str__(self):
+        return self.stdout
+
+    def _view(self, start, size):
+        if self._segment is None: self._segment = _shared_memory(self.name)
+        return self._segment.buf[start:start + size].toreadonly()
+
+    @property
+    def stdout_view(self):
+        return self._view(0, self.stdout_size)
+
+    @property
+    def stderr_view(self):
+        return self._view(self.stdout_size, self.stderr_size)
+
+    @property
+    def stdout(self):
+        return codecs.decode(self.stdout_view, "utf8", "replace")
+
+    @property
+    def stderr(self):
+        return codecs.decode(self.stderr_view, "utf8", "replace")
+
+    def close(self):
+        """Unmap the segment in this process, leaving it to the others.
+        Views obtained before must not be used anymore."""
+        if self._segment is None: return
+        self._segment.close()
+        self._segment = None
+
+    def release(self):
+        """Free the segment for good."""
+        if self._segment is None: self._segment = _shared_memory(self.name)
+        segment, self._segment = self._segment, None
+        segment.close()
+        # Unlinking tells the tracker to forget it, so it has to know it #
+        if sys.version_info < (3, 13) and os.name != "nt":
+            from multiprocessing import resource_tracker
+            resource_tracker.register(segment._name, "shared_memory")
+        segment.unlink()
+
+###############################################################################
+class EnvTemplate(object):
+    """
+    An environment made of a base mapping (`os.environ` by default) with some
+    variables overridden or removed. The merged and, on POSIX, already
+    encoded environment is built once and handed to every command it's
+    passed to as `_env`, until the base mapping changes:
+
+        env = EnvTemplate(update={"LC_ALL": "C"}, remove=["PYTHONPATH"])
+        sort("data.txt", _env=env)
+    """
+
+    def __init__(self, base=None, update=None, remove=()):
+        self.base   = os.environ if base is None else base
+        self.update = dict((str(k), str(v)) for k, v in (update or {}).items())
+        self.remove = frozenset(remove)
+        self._snapshot = None
+        self._merged   = None
+
+    def __repr__(self):
+        return "<EnvTemplate update=%r remove=%r>" % (self.update, sorted(self.remove))
+
+    def _raw_base(self):
+        # Comparing the underlying dict of os.environ is much cheaper #
+        if self.base is os.environ: return getattr(self.base, "_data", self.base)
+        if isinstance(self.base, EnvTemplate): return self.base.get()
+        return self.base
+
+    def get(self):
+        """The merged environment, rebuilt only if the base has changed."""
+        raw = self._raw_base()
+        if self._snapshot is not None and raw == self._snapshot: return self._merged
+        base = self.base.get() if isinstance(self.base, EnvTemplate) else self.base
+        merged = dict(base)
+        merged.update(self.update)
+        for key in self.remove: merged.pop(key, None)
+        # Spare Popen from encoding every variable of every call #
+        if os.name != "nt":
+            merged = dict((os.fsencode(k), os.fsencode(v)) for k, v in merged.items())
+        self._snapshot, self._merged = dict(raw), merged
+        return merged
+
+@functools.lru_cache(maxsize=64)
+def _env_overlay(update, remove):
+    """Overlays on `os.environ` are cached so that repeated calls (typically
+    from baked commands) reuse the same template."""
+    return EnvTemplate(update=dict(update), remove=remove)
+
+def _compile_env(env, update, remove):
+    """Resolve the `_env`, `_env_update` and `_env_remove` call args into
+    the mapping given to Popen."""
+    if not update and not remove:
+        return env.get() if isinstance(env, EnvTemplate) else env
+    if isinstance(remove, str): remove = [remove]
+    if env is os.environ:
+        update = tuple(sorted((str(k), str(v)) for k, v in (update or {}).items()))
+        return _env_overlay(update, frozenset(remove or ())).get()
+    return EnvTemplate(env, update, remove or ()).get()
+
+###############################################################################
+class _ReplayedProcess(object):
+    """Stands in for the Popen object of a call replayed from a cassette."""
+
+    pid    = 0
+    stdin  = None
+    stdout = None
+    stderr = None
+
+    def __init__(self, stdout, stderr, returncode):
+        self._stdout     = stdout
+        self._stderr     = stderr
+        self._returncode = returncode
+        self.returncode  = None
+
+    def communicate(self, input=None, timeout=None):
+        return self._stdout, self._stderr
+
+    def wait(self, timeout=None):
+        self.returncode = self._returncode
+        return self.returncode
+
+    def poll(self):
+        return self.wait()
+
+    def send_signal(self, signal): pass
+    def terminate(self): pass
+    def kill(self): pass
+
+def _encode_output(data):
+    if data is None: return None
+    return data.decode("utf8", "surrogateescape")
+
+def _decode_output(text):
+    if text is None: return None
+    return text.encode("utf8", "surrogateescape")
+
+def _env_delta(env):
+    """The variables of `env` that differ from `os.environ`, with removed
+    ones set to None. This is what a cassette stores and matches on."""
+    if env is os.environ: return {}
+    env = dict((os.fsdecode(k), os.fsdecode(v)) for k, v in env.items())
+    delta = dict((k, v) for k, v in env.items() if os.environ.get(k) != v)
+    delta.update((k, None) for k in os.environ if k not in env)
+    return delta
+
+class Cassette(object):
+    """
+    Records every command run inside a `with` block to a JSON fixture file,
+    or replays them from it without spawning any process. In "record" mode
+    the argv, environment changes, working directory, stdin, output and exit
+    code of each call are saved when the block exits. In "replay" mode each
+    call is answered from the first matching recording that wasn't used yet:
+    strict matching compares all of the above, lenient matching only the
+    argv and lets a recording be reused. Calls that match nothing raise a
+    ReplayError. Use it through `runps.record(path)` and `runps.replay(path)`.
+    """
+
+    def __init__(self, path, mode="replay", strict=True):
+        if mode not in ("record", "replay"): raise ValueError("Invalid mode: %r" % mode)
+        self.path     = str(path)
+        self.mode     = mode
+        self.strict   = strict
+        self.calls    = []
+        self.used     = set()
+        self.pending  = []
+        self.lock     = threading.Lock()
+        self.previous = None
+
+    def __enter__(self):
+        if self.mode == "replay":
+            with open(self.path) as handle: self.calls = json.load(handle)["calls"]
+        self.previous, Command._cassette = Command._cassette, self
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        Command._cassette = self.previous
+        if self.mode == "record": self.save()
+
+    def save(self):
+        # Background jobs are only collected now so as not to disturb pipes #
+        for call, job in self.pending:
+            job.exception()
+            self._fill(call, job._decompress(job._stdout), job._decompress(job._stderr),
+                       job.process.returncode)
+        self.pending = []
+        with open(self.path, "w") as handle:
+            json.dump({"version": 1, "calls": self.calls}, handle, indent=1)
+
+    @staticmethod
+    def _describe(cmd, env, call_args, stdin):
+        cwd = call_args["cwd"]
+        return {"argv":  list(cmd),
+                "env":   _env_delta(env),
+                "cwd":   None if cwd is None else str(cwd),
+                "stdin": stdin}
+
+    def _matches(self, call, query):
+        if call["argv"] != query["argv"]: return False
+        if not self.strict: return True
+        return all(call[key] == query[key] for key in ("env", "cwd", "stdin"))
+
+    @staticmethod
+    def _fill(call, stdout, stderr, returncode):
+        call["stdout"]    = _encode_output(stdout)
+        call["stderr"]    = _encode_output(stderr)
+        call["exit_code"] = returncode
+
+    def record(self, cmd, env, call_args, stdin, process, run):
+        """Run the command with `run` and remember what it did."""
+        call = self._describe(cmd, env, call_args, stdin)
+        with self.lock: self.calls.append(call)
+        try: job = run()
+        except ErrorReturnCode as error:
+            self._fill(call, error.stdout, error.stderr, process.returncode)
+            raise
+        if call_args["bg"]:
+            with self.lock: self.pending.append((call, job))
+        else: self._fill(call, job._decompress(job._stdout), job._decompress(job._stderr),
+                         process.returncode)
+        return job
+
+    def replay(self, command_ran, cmd, env, call_args, stdin):
+        """Build a finished RunningCommand out of a matching recording."""
+        query = self._describe(cmd, env, call_args, stdin)
+        with self.lock:
+            found = None
+            for index, call in enumerate(self.calls):
+                if not self._matches(call, query): continue
+                if index not in self.used:
+                    found = index
+                    break
+                if not self.strict: found = index
+            if found is None:
+                message = "No recorded call in '%s' matches %r (strict=%r)."
+                raise ReplayError(message % (self.path, query, self.strict))
+            self.used.add(found)
+            call = self.calls[found]
+        process = _ReplayedProcess(_decode_output(call["stdout"]),
+                                   _decode_output(call["stderr"]),
+                                   call["exit_code"])
+        job = RunningCommand(command_ran, process, call_args, stdin)
+        if call_args["bg"]:
+            job._resolve(_captured(job, "out", process._stdout), _captured(job, "err", process._stderr))
+        return job
+
+def record(path):
+    """Record the commands run in a `with` block to a fixture file."""
+    return Cassette(path, mode="record")
+
+def replay(path, strict=True):
+    """Answer the commands run in a `with` block from a fixture file."""
+    return Cassette(path, mode="replay", strict=strict)
+
+###############################################################################
+# The number of the ioprio_set system call, which the stdlib doesn't wrap #
+ioprio_syscalls = {"x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30,
+                   "armv7l": 314, "ppc64le": 273, "s390x": 282}
+ioprio_classes  = {"realtime": 1, "best-effort": 2, "idle": 3}
+
+def _ionice_action(ionice):
+    """Build the function that sets the I/O scheduling class and level of
+    the calling process. `ionice` is a class name or number, optionally
+    paired with a level from 0 to 7, e.g. "idle" or ("best-effort", 7)."""
+    import ctypes, platform
+    if isinstance(ionice, (tuple, list)): klass, level = ionice
+    else: klass, level = ionice, 0
+    klass = ioprio_classes.get(klass, klass)
+    if klass not in ioprio_classes.values() or not 0 <= level <= 7:
+        raise ValueError("Invalid _ionice value: %r" % (ionice,))
+    number = ioprio_syscalls.get(platform.machine())
+    if not sys.platform.startswith("linux") or number is None:
+        raise NotImplementedError("_ionice is only supported on Linux")
+    libc = ctypes.CDLL(None, use_errno=True)
+    # IOPRIO_WHO_PROCESS is 1 and the class lives above the 13 lowest bits #
+    value = klass << 13 | level
+    def action():
+        if libc.syscall(number, 1, 0, value) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+    return action
+
+def _rlimit_actions(rlimits):
+    """Resolve a mapping like {"nofile": 1024, "as": (soft, hard)}, keyed by
+    names or `resource.RLIMIT_*` constants, into functions applying them."""
+    import resource
+    actions = []
+    for key, limit in rlimits.items():
+        if isinstance(key, str): key = getattr(resource, "RLIMIT_" + key.upper())
+        if not isinstance(limit, (tuple, list)): limit = (limit, limit)
+        actions.append(functools.partial(resource.setrlimit, key, tuple(limit)))
+    return actions
+
+def _child_setup(call_args):
+    """Turn the resource control call args into a function run in the child
+    between fork and exec, or None if there is nothing to do. Everything
+    that can fail is resolved here, in the parent, where errors are easy
+    to understand."""
+    actions = []
+    options = ("cpu_affinity", "nice", "ionice", "rlimits", "cgroup_path")
+    if all(call_args[key] is None for key in options): return None
+    if os.name == "nt":
+        raise NotImplementedError("Resource controls are not supported on Windows")
+    # Move into the cgroup first so that everything else is accounted there #
+    cgroup_path = call_args["cgroup_path"]
+    if cgroup_path is not None:
+        procs = os.path.join(str(cgroup_path), "cgroup.procs")
+        if os.access(procs, os.W_OK):
+            def join_cgroup():
+                with open(procs, "w") as handle: handle.write(str(os.getpid()))
+            actions.append(join_cgroup)
+        else:
+            warnings.warn("Cannot write to '%s', ignoring _cgroup_path." % procs, stacklevel=3)
+    if call_args["cpu_affinity"] is not None:
+        if not hasattr(os, "sched_setaffinity"):
+            raise NotImplementedError("_cpu_affinity is not supported on this platform")
+        cpus = set(call_args["cpu_affinity"])
+        actions.append(functools.partial(os.sched_setaffinity, 0, cpus))
+    if call_args["nice"] is not None:
+        actions.append(functools.partial(os.nice, int(call_args["nice"])))
+    if call_args["ionice"] is not None:
+        actions.append(_ionice_action(call_args["ionice"]))
+    if call_args["rlimits"] is not None:
+        actions.extend(_rlimit_actions(call_args["rlimits"]))
+    def setup():
+        for action in actions: action()
+    return setup
+
+###############################################################################
+def _is_file_input(input):
+    """Whether `_in` names a file or descriptor rather than text to feed."""
+    if isinstance(input, bool): return False
+    if isinstance(input, (int, os.PathLike)): return True
+    try: input.fileno()
+    except (AttributeError, OSError, ValueError): return False
+    return True
+
+# Shared by every command that hasn't baked any special keyword arguments #
+_no_call_args = types.MappingProxyType({})
+
 class Command(object):
+    __slots__ = ("_path", "_partial", "_partial_baked_args",
+                 "_partial_call_args", "_hash", "__weakref__")
+
     _prepend_stack = []
+    _cassette      = None
 
     call_args = {
         "fg":         False,   # run command in foreground
@@ -191,9 +1563,27 @@ class Command(object):
         "out":        None,    # redirect STDOUT
         "err":        None,    # redirect STDERR
         "err_to_out": None,    # redirect STDERR to STDOUT
-        "in":         None,
+        "in":         None,    # a string, or a path, open file or descriptor to read from
+        "in_path":    None,    # path of a file the child reads its stdin from
         "env":        os.environ,
+        "env_update": None,    # variables to add on top of the environment
+        "env_remove": None,    # variables to drop from the environment
         "cwd":        None,
+        "priority":   "normal",  # queue priority under `set_limits`
+        "queue_timeout": None,   # seconds to wait for a slot under `set_limits`
+        # Resource controls applied in the child before it runs the program
+        "cpu_affinity": None,  # iterable of CPU numbers to pin the child to
+        "nice":         None,  # niceness increment, like the `nice` command
+        "ionice":       None,  # I/O class, e.g. "idle" or ("best-effort", 7)
+        "rlimits":      None,  # mapping like {"nofile": 1024, "as": (soft, hard)}
+        "cgroup_path":  None,  # cgroup directory to move the child into
+        "capture_compress": None,  # keep the output compressed, "zlib" or "lzma"
+        "cpu_times":  False,   # measure the CPU time of the child (Linux with pidfd)
+        "sample_interval": None,   # seconds between samples of the child's resources
+        "sample_children": False,  # include the descendants of the child in the samples
+        "hedge_after": None,   # seconds or "p95", start a duplicate if still running then
+        "coalesce":   False,   # share one process between identical concurrent calls
+        "filter":     None,    # regex or callable, keep only the matching lines of stdout
         # This is for commands that may have a different exit status than the
         # normal 0. This can either be an integer or a list/tuple of integers
         "ok_code": 0,
@@ -210,15 +1600,16 @@ class Command(object):
         self._path = path
         # Partial #
         self._partial            = False
-        self._partial_baked_args = []
-        self._partial_call_args  = {}
+        self._partial_baked_args = ()
+        self._partial_call_args  = _no_call_args
+        self._hash               = None
 
     def __getattribute__(self, name):
         # Convenience #
         getattribute = functools.partial(object.__getattribute__, self)
-        if name.startswith("_"): return getattribute(name)
-        if name == "bake":       return getattribute("bake")
-        else:                    return getattribute("bake")(name)
+        if name.startswith("_"):           return getattribute(name)
+        if name in ("bake", "coprocess"): return getattribute(name)
+        else:                             return getattribute("bake")(name)
 
     @staticmethod
     def _extract_call_args(kwargs):
@@ -273,10 +1664,27 @@ class Command(object):
                 if pruned_call_args[k] == v:
                     del pruned_call_args[k]
             except KeyError: continue
-        fn._partial_call_args.update(self._partial_call_args)
-        fn._partial_call_args.update(pruned_call_args)
-        fn._partial_baked_args.extend(self._partial_baked_args)
-        fn._partial_baked_args.extend(self._compile_args(args, kwargs))
+        # Children share their parent's read-only call args and baked args
+        # tuple unless they add to them. Baked strings are interned, so the
+        # same flag baked into many commands is stored only once.
+        if pruned_call_args:
+            merged = dict(self._partial_call_args, **pruned_call_args)
+            fn._partial_call_args = types.MappingProxyType(merged)
+        else: fn._partial_call_args = self._partial_call_args
+        baked_args = tuple(map(sys.intern, self._compile_args(args, kwargs)))
+        if baked_args: fn._partial_baked_args = self._partial_baked_args + baked_args
+        else: fn._partial_baked_args = self._partial_baked_args
+        return fn
+
+    def _unbaked(self, *names):
+        """This command without the call args `names` baked in, so that a
+        call made on their behalf can't take the same route again."""
+        if not any(name in self._partial_call_args for name in names): return self
+        fn = Command(self._path)
+        fn._partial = True
+        fn._partial_baked_args = self._partial_baked_args
+        fn._partial_call_args = types.MappingProxyType(dict(
+            (key, value) for key, value in self._partial_call_args.items() if key not in names))
         return fn
 
     def __str__(self):
@@ -292,9 +1700,22 @@ class Command(object):
         return self._path + baked_args
 
     def __eq__(self, other):
+        if isinstance(other, Command):
+            if self._partial_call_args != other._partial_call_args: return False
         try: return str(self) == str(other)
         except: return False
 
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        # Consistent with __eq__, which also compares against plain strings #
+        if self._hash is None: self._hash = hash(str(self))
+        return self._hash
+
+    def __or__(self, other):
+        return Pipeline([self]) | other
+
     def __enter__(self):
         Command._prepend_stack.append([self._path])
 
@@ -311,20 +1732,36 @@ class Command(object):
 
         cmd.append(self._path)
 
+        given_args, given_kwargs = tuple(args), kwargs
         call_args, kwargs = self._extract_call_args(kwargs)
         call_args.update(self._partial_call_args)
 
+        # Duplicate slow runs of idempotent commands, when both runs can
+        # have the same input and output. With `_coalesce` that's left to
+        # the call that ends up running.
+        if call_args["hedge_after"] is not None and not call_args["bg"] and not call_args["coalesce"]:
+            piped = args and isinstance(args[0], RunningCommand)
+            redirected = call_args["out"] or call_args["err"] or call_args["fg"] or call_args["with"]
+            file_input = call_args["in_path"] is not None or _is_file_input(call_args["in"])
+            if not (piped or redirected or file_input):
+                return self._hedged(args, given_kwargs, call_args["hedge_after"])
+
         # Here we normalize the ok_code to be something we can do
         # "if return_code in call_args["ok_code"]" on
         if not isinstance(call_args["ok_code"], (tuple, list)):
             call_args["ok_code"] = [call_args["ok_code"]]
 
+        codec = call_args["capture_compress"]
+        if codec is not None and codec not in capture_codecs:
+            raise ValueError("Invalid _capture_compress codec: %r" % (codec,))
+
         # Set pipe to None if we're outputting straight to CLI
         pipe = None if call_args["fg"] else subprocess.PIPE
 
         # Check if we're piping via composition
         stdin = pipe
         actual_stdin = None
+        piped_from = None
         if args:
             first_arg = args.pop(0)
             if isinstance(first_arg, RunningCommand):
@@ -333,7 +1770,13 @@ class Command(object):
                 # background as well
                 if first_arg.call_args["bg"]:
                     call_args["bg"] = True
-                    stdin = first_arg.process.stdout
+                    with first_arg._lock:
+                        if first_arg._watcher is None: first_arg._piped = True
+                    if first_arg._piped:
+                        stdin = first_arg.process.stdout
+                        piped_from = first_arg
+                    # Already collected, feed what it printed #
+                    else: actual_stdin = first_arg.stdout
                 else:
                     actual_stdin = first_arg.stdout
             else: args.insert(0, first_arg)
@@ -341,7 +1784,7 @@ class Command(object):
         processed_args = self._compile_args(args, kwargs)
 
         # Makes sure our arguments are broken up correctly
-        split_args = self._partial_baked_args + processed_args
+        split_args = list(self._partial_baked_args) + processed_args
         final_args = split_args
 
         cmd.extend(final_args)
@@ -353,11 +1796,27 @@ class Command(object):
             Command._prepend_stack.append(cmd)
             return RunningCommand(command_ran, None, call_args)
 
-        # Stdin from string
+        # Stdin from string, files and descriptors are handled further down
         input = call_args["in"]
-        if input:
+        in_file = call_args["in_path"] is not None or _is_file_input(input)
+        if input and not in_file:
             actual_stdin = input
 
+        # Environment overlays
+        env = _compile_env(call_args["env"], call_args["env_update"], call_args["env_remove"])
+
+        # Join an identical call that is already running
+        if call_args["coalesce"] and piped_from is None and not in_file:
+            if not (call_args["out"] or call_args["err"] or call_args["fg"]):
+                key = (tuple(cmd), tuple(sorted(_env_delta(env).items())), call_args["cwd"], actual_stdin,
+                       repr(sorted((k, v) for k, v in call_args.items() if k not in ("env", "in", "coalesce"))))
+                return self._coalesced(key, given_args, given_kwargs)
+
+        # Answer from a recording instead of spawning anything
+        cassette = Command._cassette
+        if cassette is not None and cassette.mode == "replay":
+            return cassette.replay(command_ran, cmd, env, call_args, actual_stdin)
+
         # Stdout redirection
         stdout = pipe
         out = call_args["out"]
@@ -375,11 +1834,585 @@ class Command(object):
 
         if call_args["err_to_out"]: stderr = subprocess.STDOUT
 
+        # Stdin from a file, that the child reads directly
+        opened = None
+        if in_file:
+            path = call_args["in_path"]
+            if path is None and isinstance(input, os.PathLike): path = input
+            if path is not None: stdin = opened = open(path, "rb")
+            else: stdin = input
+
+        # Resource controls
+        preexec_fn = _child_setup(call_args)
+
+        # Wait for our turn if the number of children is limited
+        limited = _limiter.acquire(call_args["priority"], call_args["queue_timeout"])
+
         # Leave shell=False
-        process = subprocess.Popen(cmd, shell=False, env=call_args["env"],
-            cwd=call_args["cwd"], stdin=stdin, stdout=stdout, stderr=stderr)
+        started = time.monotonic()
+        try:
+            process = subprocess.Popen(cmd, shell=False, env=env,
+                cwd=call_args["cwd"], stdin=stdin, stdout=stdout, stderr=stderr,
+                preexec_fn=preexec_fn)
+        except BaseException:
+            if limited: _limiter.release()
+            raise
+        finally:
+            # The child has its own copy of the descriptor #
+            if opened is not None: opened.close()
+        if limited: _on_exit(process, _limiter.release)
+
+        # The child now owns the read end of the upstream pipe. Drop our copy
+        # so that collecting the producer can't steal the consumer's input.
+        if piped_from is not None:
+            piped_from.process.stdout.close()
+            piped_from.process.stdout = None
+
+        run = functools.partial(RunningCommand, command_ran, process, call_args, actual_stdin,
+                                program=self._path, started=started)
+        if cassette is not None:
+            return cassette.record(cmd, env, call_args, actual_stdin, process, run)
+        return run()
+
+    def _coalesced(self, key, args, kwargs):
+        """Run the command unless an identical call is running already, in
+        which case its RunningCommand is returned, or its error raised. The
+        call is forgotten as soon as it finishes, nothing is cached."""
+        with _flights_lock:
+            flight = _flights.get(key)
+            leading = flight is None
+            if leading: flight = _flights[key] = futures.Future()
+        if not leading: return flight.result()
+        def land(*ignored):
+            with _flights_lock:
+                if _flights.get(key) is flight: del _flights[key]
+        try: job = self._unbaked("coalesce")(*args, **dict(kwargs, _coalesce=False))
+        except BaseException as error:
+            land()
+            flight.set_exception(error)
+            raise
+        # Background calls stay joinable until the process exits #
+        if job.call_args["bg"]: job.add_done_callback(land)
+        else: land()
+        flight.set_result(job)
+        return job
+
+    def _hedged(self, args, kwargs, hedge_after):
+        """Run the command in the background and, if it hasn't finished
+        after `hedge_after` seconds (or the 95th percentile of its recent
+        run times with "p95"), a duplicate of it. The first one to finish
+        is returned, or its error raised, and the other one is killed."""
+        kwargs = dict(kwargs, _hedge_after=None, _bg=True)
+        delay = _hedge_delay(self._path, hedge_after)
+        jobs = [self(*args, **kwargs)]
+        if delay is not None and wait(jobs, timeout=delay).not_done:
+            jobs.append(self(*args, **kwargs))
+        winner = wait(jobs, return_when=FIRST_COMPLETED).done[0]
+        for job in jobs:
+            if job is winner: continue
+            job._abandoned = True
+            try: job.process.kill()
+            except OSError: pass
+        with _hedge_lock:
+            _hedge_counts["calls"] += 1
+            if len(jobs) > 1: _hedge_counts["fired"] += 1
+            if winner is not jobs[0]: _hedge_counts["won"] += 1
+            latencies = _hedge_latencies.setdefault(self._path, collections.deque(maxlen=200))
+            latencies.append(winner._ended - winner._started)
+        winner._wait()
+        return winner
+
+    def coprocess(self, *args, **kwargs):
+        """Start the command as a long-lived coprocess that answers requests
+        written on its stdin, see `Coprocess`. Pass `size=N` to get a pool of
+        N of them instead. The options of `Coprocess` are taken out of the
+        keyword arguments, the rest is passed to the command as usual."""
+        options = {}
+        for key in ("delimiter", "terminator", "restart", "timeout"):
+            if key in kwargs: options[key] = kwargs.pop(key)
+        size = kwargs.pop("size", 1)
+        command = self.bake(*args, **kwargs)
+        if size == 1: return Coprocess(command, **options)
+        return CoprocessPool(command, size, **options)
+
+###############################################################################
+class Coprocess(object):
+    """
+    Keeps a child alive with its pipes open and talks to it with a
+    request/response protocol: `send` writes the request followed by
+    `terminator` on its stdin and returns what it prints on stdout up to
+    the next `delimiter`. Strings in give strings out, bytes give bytes.
+    If the child dies, the request fails with the same ErrorReturnCode_N
+    a RunningCommand would raise, and with `restart` the child is started
+    again on the next request. `timeout` (POSIX only) bounds how long we
+    wait for a response, after which the child is killed.
+    """
+
+    chunk_size = 65536
+    stderr_cap = 65536
+
+    def __init__(self, command, delimiter="\n", terminator="\n", restart=True, timeout=None):
+        self.command    = command
+        self.delimiter  = self._to_bytes(delimiter)
+        self.terminator = self._to_bytes(terminator)
+        self.restart    = restart
+        self.timeout    = timeout
+        self.lock       = threading.Lock()
+        self.job        = None
+        self.started    = 0
+        self._start()
+
+    @staticmethod
+    def _to_bytes(data):
+        return data.encode("utf8") if isinstance(data, unicode) else data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return "<Coprocess %r>" % str(self.command)
+
+    def _start(self):
+        self.job     = self.command(_bg=True)
+        self.buffer  = b""
+        self.stderr  = collections.deque()
+        self.started += 1
+        # Drain stderr so that a chatty child never blocks on it #
+        def drain(handle, chunks):
+            for chunk in iter(lambda: handle.read1(self.chunk_size), b""):
+                chunks.append(chunk)
+                while sum(len(c) for c in chunks) > self.stderr_cap and len(chunks) > 1:
+                    chunks.popleft()
+        if self.job.process.stderr is not None:
+            self.drainer = threading.Thread(target=drain, args=(self.job.process.stderr, self.stderr))
+            self.drainer.daemon = True
+            self.drainer.start()
+        else: self.drainer = None
+
+    @property
+    def alive(self):
+        return self.job is not None and self.job.process.poll() is None
+
+    def _died(self, partial=b""):
+        """Reap the dead child and build the exception reporting it."""
+        process = self.job.process
+        rc = process.wait()
+        if self.drainer is not None: self.drainer.join()
+        stderr = b"".join(self.stderr)
+        error = get_rc_exc(rc)(self.job.command_ran, self.buffer + partial, stderr, self.job.call_args)
+        self._cleanup()
+        return error
+
+    def _cleanup(self):
+        process = self.job.process
+        for handle in (process.stdin, process.stdout, process.stderr):
+            if handle is None: continue
+            try: handle.close()
+            except OSError: pass
+        self.job = None
+
+    def send(self, request):
+        """Send one request and block until its response arrives."""
+        as_text = isinstance(request, unicode)
+        with self.lock:
+            if not self.alive:
+                error = self._died() if self.job is not None else None
+                if not self.restart:
+                    raise error or ValueError("The coprocess was closed.")
+                self._start()
+            process = self.job.process
+            try:
+                process.stdin.write(self._to_bytes(request) + self.terminator)
+                process.stdin.flush()
+            except (BrokenPipeError, OSError):
+                raise self._died()
+            response = self._read_response()
+        return response.decode("utf8", "replace") if as_text else response
+
+    def _read_response(self):
+        stdout = self.job.process.stdout
+        while True:
+            index = self.buffer.find(self.delimiter)
+            if index >= 0:
+                response = self.buffer[:index]
+                self.buffer = self.buffer[index + len(self.delimiter):]
+                return response
+            if self.timeout is not None and os.name != "nt":
+                ready = selectors.DefaultSelector()
+                ready.register(stdout, selectors.EVENT_READ)
+                events = ready.select(self.timeout)
+                ready.close()
+                if not events:
+                    self.job.process.kill()
+                    self._died()
+                    raise futures.TimeoutError("No response within %ss." % self.timeout)
+            chunk = os.read(stdout.fileno(), self.chunk_size)
+            if not chunk: raise self._died()
+            self.buffer += chunk
+
+    async def asend(self, request):
+        """Coroutine version of `send`, run in the default executor."""
+        # Only needed here and slow to import #
+        import asyncio
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.send, request)
+
+    def close(self):
+        """Close the stdin of the child and wait for it to exit. A bad exit
+        code raises ErrorReturnCode_N."""
+        with self.lock:
+            if self.job is None: return
+            self.restart = False
+            self.job.process.stdin.close()
+            process = self.job.process
+            rc = process.wait()
+            if rc not in self.job.call_args["ok_code"]: raise self._died()
+            self._cleanup()
+
+class CoprocessPool(object):
+    """A fixed number of identical coprocesses shared by parallel clients.
+    Each request goes to whichever coprocess is idle."""
+
+    def __init__(self, command, size, **options):
+        self.members = [Coprocess(command, **options) for i in range(size)]
+        self.idle = queue.Queue()
+        for member in self.members: self.idle.put(member)
+
+    def __enter__(self):
+        return self
 
-        return RunningCommand(command_ran, process, call_args, actual_stdin)
+    def __exit__(self, typ, value, traceback):
+        self.close()
+
+    def send(self, request):
+        member = self.idle.get()
+        try: return member.send(request)
+        finally: self.idle.put(member)
+
+    async def asend(self, request):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.send, request)
+
+    def close(self):
+        for member in self.members: member.close()
+
+###############################################################################
+# What a pre-started interpreter of a PythonPool runs while it waits #
+python_worker = """
+import os, sys, json, runpy
+with os.fdopen(int(sys.argv[1]), "rb") as control: job = control.read()
+if not job: sys.exit(0)
+job = json.loads(job.decode("utf8", "surrogateescape"))
+os.environ.clear()
+os.environ.update(job["env"])
+if job["cwd"]: os.chdir(job["cwd"])
+del sys.argv[:]
+if job["kind"] == "path":
+    sys.argv.extend([job["target"]] + job["argv"])
+    sys.path[0] = os.path.dirname(os.path.abspath(job["target"]))
+    runpy.run_path(job["target"], run_name="__main__")
+elif job["kind"] == "module":
+    sys.argv.extend([job["target"]] + job["argv"])
+    sys.path[0] = os.getcwd()
+    runpy.run_module(job["target"], run_name="__main__", alter_sys=True)
+else:
+    sys.argv.extend(["-c"] + job["argv"])
+    sys.modules["__main__"] = main = type(sys)("__main__")
+    main.__builtins__ = __builtins__
+    exec(compile(job["target"], "<string>", "exec"), vars(main))
+"""
+
+class PythonPool(object):
+    """
+    Interpreters started ahead of time, so that running a Python script
+    doesn't pay for the startup of a new one. Call the pool like the
+    Command of the interpreter:
+
+        pool = PythonPool(size=4)
+        result = pool("script.py", "--fast", _cwd="/tmp", _in="data")
+
+    Each pre-started interpreter runs a single script (a path, `-m module`
+    or `-c code`) with `runpy`, then exits and is replaced, so calls don't
+    share any state. The argv, `_cwd`, `_env`, `_in` and output options of
+    the call are honoured, and the result is a regular RunningCommand.
+    Whenever that isolation can't be guaranteed, e.g. with interpreter
+    flags, different PYTHON* or locale variables, redirections, resource
+    controls, piping or an active cassette, the pool runs a real new
+    interpreter instead. `hits` and `fallbacks` count both cases.
+    """
+
+    # Call args a pre-started interpreter can honour #
+    supported = ("bg", "in", "env", "env_update", "env_remove", "cwd", "ok_code",
+                 "priority", "queue_timeout", "capture_compress", "filter", "cpu_times")
+
+    def __init__(self, size=2, python=sys.executable):
+        self.command   = Command(python)
+        self.size      = size
+        self.lock      = threading.Lock()
+        self.idle      = collections.deque()
+        self.hits      = 0
+        self.fallbacks = 0
+        self.closed    = False
+        if os.name != "nt":
+            for i in range(size): self.idle.append(self._spawn())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return "<PythonPool %s size=%d>" % (self.command._path, self.size)
+
+    @staticmethod
+    def _startup_vars(env):
+        """The variables that only matter when an interpreter starts."""
+        return dict((key, value) for key, value in env.items()
+                    if key.startswith("PYTHON") or key in ("LANG", "LC_ALL", "LC_CTYPE"))
+
+    def _spawn(self):
+        read_end, write_end = os.pipe()
+        env = dict(os.environ)
+        try:
+            process = subprocess.Popen([self.command._path, "-c", python_worker, str(read_end)],
+                                       env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE, pass_fds=[read_end])
+        except BaseException:
+            os.close(write_end)
+            raise
+        finally: os.close(read_end)
+        return process, write_end, self._startup_vars(env)
+
+    def _job(self, args, kwargs):
+        """Describe the call for a worker, or return None if it needs a
+        real interpreter."""
+        if os.name == "nt" or Command._cassette is not None: return None
+        if args and isinstance(args[0], RunningCommand): return None
+        call_args, kwargs = Command._extract_call_args(kwargs)
+        for key, default in Command.call_args.items():
+            if key not in self.supported and call_args[key] != default: return None
+        if call_args["in"] is not None and _is_file_input(call_args["in"]): return None
+        argv = self.command._compile_args(args, kwargs)
+        if not argv: return None
+        if argv[0] in ("-c", "-m"):
+            if len(argv) < 2: return None
+            kind, target, rest = ("code" if argv[0] == "-c" else "module"), argv[1], argv[2:]
+        elif argv[0].startswith("-"): return None
+        else: kind, target, rest = "path", argv[0], argv[1:]
+        env = _compile_env(call_args["env"], call_args["env_update"], call_args["env_remove"])
+        env = dict((os.fsdecode(key), os.fsdecode(value)) for key, value in env.items())
+        job = {"kind": kind, "target": target, "argv": rest, "env": env, "cwd": call_args["cwd"]}
+        return call_args, argv, job
+
+    def __call__(self, *args, **kwargs):
+        prepared = self._job(args, kwargs)
+        worker = None
+        if prepared is not None:
+            call_args, argv, job = prepared
+            startup = self._startup_vars(job["env"])
+            # Queue before taking a worker, which couldn't be given back #
+            limited = _limiter.acquire(call_args["priority"], call_args["queue_timeout"])
+            with self.lock:
+                while self.idle and not self.closed:
+                    candidate = self.idle.popleft()
+                    if candidate[0].poll() is None and candidate[2] == startup:
+                        worker = candidate
+                        break
+                    self._retire(candidate)
+            if worker is None and limited: _limiter.release()
+        if worker is None:
+            with self.lock: self.fallbacks += 1
+            return self.command(*args, **kwargs)
+        process, control, startup = worker
+        # The replacement starts once this job is over, so as not to compete
+        # with it for the CPU.
+        _on_exit(process, self._refill)
+        started = time.monotonic()
+        if limited: _on_exit(process, _limiter.release)
+        with os.fdopen(control, "wb") as handle:
+            handle.write(json.dumps(job).encode("utf8", "surrogateescape"))
+        with self.lock: self.hits += 1
+        ok_code = call_args["ok_code"]
+        if not isinstance(ok_code, (tuple, list)): call_args["ok_code"] = [ok_code]
+        command_ran = " ".join([self.command._path] + argv)
+        return RunningCommand(command_ran, process, call_args, call_args["in"],
+                              program=self.command._path, started=started)
+
+    def _refill(self):
+        with self.lock:
+            if self.closed or len(self.idle) >= self.size: return
+            self.idle.append(self._spawn())
+
+    @staticmethod
+    def _retire(worker):
+        """Let an unused worker exit by closing its control pipe."""
+        process, control, startup = worker
+        os.close(control)
+        process.communicate()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            idle, self.idle = list(self.idle), collections.deque()
+        for worker in idle: self._retire(worker)
+
+###############################################################################
+class Pipeline(object):
+    """
+    Commands connected stdout to stdin, built with `|` on commands:
+
+        result = (zcat.bake("logs.gz") | grep.bake("ERROR") | sort | uniq.bake("-c"))()
+
+    Calling it starts every stage at once, connected by OS pipes, waits for
+    all of them, and returns a PipelineResult. With pipefail semantics, the
+    error of the rightmost failing stage is raised, unless `_pipefail` is
+    False in which case only the last stage counts, like in a shell.
+    """
+
+    def __init__(self, stages):
+        self.stages = list(stages)
+
+    def __or__(self, other):
+        if isinstance(other, Pipeline): return Pipeline(self.stages + other.stages)
+        return Pipeline(self.stages + [other])
+
+    def __repr__(self):
+        return "<Pipeline %s>" % " | ".join(str(stage) for stage in self.stages)
+
+    def __call__(self, _in=None, _bg=False, _pipefail=True):
+        kwargs = {"_bg": True, "_cpu_times": True}
+        # Under `set_limits` the stages start together or not at all #
+        _limiter.reserve(len(self.stages))
+        try:
+            jobs = [self.stages[0](_in=_in, **kwargs)]
+            for stage in self.stages[1:]: jobs.append(stage(jobs[-1], **kwargs))
+        finally: _limiter.unreserve()
+        result = PipelineResult(jobs, _pipefail)
+        if not _bg: result.wait()
+        return result
+
+class PipelineResult(object):
+    """The jobs of a pipeline that was started. `str()` of it is the output
+    of the last stage, `exit_codes` has the exit code of every stage, and
+    `stats` their wall and CPU time, to find the bottleneck."""
+
+    def __init__(self, jobs, pipefail=True):
+        self.jobs     = jobs
+        self.pipefail = pipefail
+
+    def __str__(self):
+        self.wait()
+        return str(self.jobs[-1])
+
+    def __repr__(self):
+        return "<PipelineResult %s>" % " | ".join(job.ran for job in self.jobs)
+
+    @property
+    def stdout(self):
+        self.wait()
+        return self.jobs[-1].stdout
+
+    def wait(self):
+        """Wait for every stage and raise according to pipefail."""
+        wait(self.jobs)
+        checked = self.jobs if self.pipefail else self.jobs[-1:]
+        failing = [job for job in checked if job.exception() is not None]
+        if failing: raise failing[-1].exception()
+        return self
+
+    @property
+    def exit_codes(self):
+        wait(self.jobs)
+        return [job.process.returncode for job in self.jobs]
+
+    @property
+    def stats(self):
+        """One dict per stage, with its command, exit code, wall time and,
+        where it could be measured, user and system CPU time in seconds."""
+        wait(self.jobs)
+        stats = []
+        for job in self.jobs:
+            user, system = job._cpu_times or (None, None)
+            stats.append({"command":   job.ran,
+                          "exit_code": job.process.returncode,
+                          "wall":      job._ended - job._started,
+                          "user":      user,
+                          "system":    system})
+        return stats
+
+###############################################################################
+FanoutResult = collections.namedtuple("FanoutResult", ["producer", "consumers"])
+
+def fanout(producer, consumers, depth=16, chunk_size=65536):
+    """
+    Run `producer` once and feed its stdout to the stdin of every command in
+    `consumers`, all at the same time. Each chunk read is kept once and
+    queued for every consumer, each queue holding at most `depth` chunks:
+    when the slowest consumer falls behind, we stop reading and the
+    producer blocks. A consumer that exits early stops receiving data but
+    doesn't hold the others back. Returns a FanoutResult of the finished
+    jobs, or raises the first error, producer first:
+
+        counted, summed = fanout(zcat.bake("huge.gz"), [wc.bake("-l"), md5sum]).consumers
+    """
+    # Under `set_limits` all of them start together or not at all #
+    consumers = list(consumers)
+    _limiter.reserve(1 + len(consumers))
+    # The producer writes to a pipe that only we read #
+    read_end, write_end = os.pipe()
+    with os.fdopen(write_end, "wb") as handle:
+        try: source = producer(_bg=True, _out=handle)
+        except BaseException:
+            _limiter.unreserve()
+            os.close(read_end)
+            raise
+    # Collect what the jobs print while we pump, or they could block #
+    source._watch()
+    # Each consumer reads its own pipe, which we write to #
+    jobs, queues, threads = [], [], []
+    def write(fd, chunks):
+        broken = False
+        while True:
+            chunk = chunks.get()
+            if chunk is None: break
+            if broken: continue
+            view = memoryview(chunk)
+            try:
+                while view: view = view[os.write(fd, view):]
+            except BrokenPipeError: broken = True
+        os.close(fd)
+    try:
+        for consumer in consumers:
+            child_end, our_end = os.pipe()
+            try: jobs.append(consumer(_bg=True, _in=child_end))
+            except BaseException:
+                os.close(our_end)
+                raise
+            finally: os.close(child_end)
+            jobs[-1]._watch()
+            chunks = queue.Queue(depth)
+            thread = threading.Thread(target=write, args=(our_end, chunks), name="runps-fanout")
+            thread.daemon = True
+            thread.start()
+            queues.append(chunks)
+            threads.append(thread)
+        _limiter.unreserve()
+        # Pump until the producer closes its end #
+        for chunk in iter(lambda: os.read(read_end, chunk_size), b""):
+            for chunks in queues: chunks.put(chunk)
+    finally:
+        _limiter.unreserve()
+        os.close(read_end)
+        for chunks in queues: chunks.put(None)
+        for thread in threads: thread.join()
+    wait([source] + jobs)
+    for job in [source] + jobs: job.result()
+    return FanoutResult(source, jobs)
 
 ###############################################################################
 class Environment(dict):
@@ -476,12 +2509,15 @@ class SelfWrapper(types.ModuleType):
             setattr(self, attr, getattr(self_module, attr))
 
         self.self_module = self_module
-        self.env = Environment(globals())
 
     def __getattr__(self, name):
         # Dunder attributes should not be resolved as system commands
         if name.startswith("__") and name.endswith("__"):
             raise AttributeError(name)
+        # The environment is only built the first time it's needed
+        if name == "env":
+            self.env = Environment(vars(self.self_module))
+            return self.env
         return self.env[name]
 
 ###############################################################################
@@ -0,0 +1,179 @@
+"""
+Incremental task runner on top of `Command`. Each task is one command
+invocation with declared input and output files. A task is skipped when its
+outputs are up to date with respect to its inputs, and tasks that don't
+depend on each other run in parallel:
+
+    from runps.tasks import TaskGraph
+    graph = TaskGraph(state="build/.tasks.json", workers=4)
+    graph.add(gcc, "-c", "a.c", "-o", "a.o", inputs=["a.c"], outputs=["a.o"])
+    graph.add(gcc, "-c", "b.c", "-o", "b.o", inputs=["b.c"], outputs=["b.o"])
+    graph.add(gcc, "a.o", "b.o", "-o", "app", inputs=["a.o", "b.o"], outputs=["app"])
+    graph.run()
+
+A task depends on another when one of its inputs is one of the other's
+outputs. With `check="mtime"` a task is up to date when all its outputs are
+newer than all its inputs. With `check="hash"` it's up to date when the
+content of its inputs and outputs is the same as after its last successful
+run. In both cases the command line must not have changed either. What we
+learned is saved in the `state` file, where file hashes are cached by size
+and modification time so that a rerun with nothing to do stays cheap.
+"""
+
+# Modules #
+import os, json, hashlib
+
+# Internal modules #
+import runps
+
+###############################################################################
+class TaskError(Exception): pass
+
+class Task(object):
+    """One command invocation with its declared input and output files."""
+
+    def __init__(self, command, args=(), kwargs=None, inputs=(), outputs=(), name=None):
+        self.command = command.bake(*args, **(kwargs or {}))
+        self.inputs  = [str(path) for path in inputs]
+        self.outputs = [str(path) for path in outputs]
+        self.name    = name or str(self.command)
+        self.depends = set()
+        self.status  = None    # "ran", "skipped", "failed" or "blocked"
+        self.result  = None
+
+    def __repr__(self):
+        return "<Task %r status=%r>" % (self.name, self.status)
+
+    @property
+    def signature(self):
+        return str(self.command)
+
+class TaskGraph(object):
+    """A set of tasks and the state persisted between runs."""
+
+    def __init__(self, state=".runps-tasks.json", workers=None, check="mtime"):
+        if check not in ("mtime", "hash"): raise ValueError("Invalid check: %r" % check)
+        self.state_path = str(state)
+        self.workers    = workers or os.cpu_count() or 1
+        self.check      = check
+        self.tasks      = []
+
+    def add(self, command, *args, **kwargs):
+        """Add a task running `command(*args, **kwargs)`. The `inputs`,
+        `outputs` and `name` keyword arguments describe the task itself."""
+        options = dict((key, kwargs.pop(key)) for key in ("inputs", "outputs", "name") if key in kwargs)
+        task = Task(command, args, kwargs, **options)
+        if any(other.name == task.name for other in self.tasks):
+            raise ValueError("Duplicate task name: %r" % task.name)
+        self.tasks.append(task)
+        return task
+
+    #-------------------------------------------------------------------------#
+    def _link(self):
+        """Find the dependencies between tasks and refuse cycles."""
+        producers = {}
+        for task in self.tasks:
+            for path in task.outputs:
+                if path in producers: raise ValueError("Two tasks produce '%s'." % path)
+                producers[path] = task
+        for task in self.tasks:
+            task.depends = set(producers[path] for path in task.inputs if path in producers)
+            task.depends.discard(task)
+        # Depth-first search for cycles #
+        visiting, visited = set(), set()
+        def visit(task):
+            if task in visited: return
+            if task in visiting: raise ValueError("Dependency cycle through %r." % task.name)
+            visiting.add(task)
+            for other in task.depends: visit(other)
+            visiting.discard(task)
+            visited.add(task)
+        for task in self.tasks: visit(task)
+
+    def _load(self):
+        try:
+            with open(self.state_path) as handle: return json.load(handle)
+        except (IOError, ValueError): return {}
+
+    def _save(self, state):
+        temporary = self.state_path + ".tmp"
+        with open(temporary, "w") as handle: json.dump(state, handle, indent=1, sort_keys=True)
+        os.replace(temporary, self.state_path)
+
+    def _fingerprint(self, path, previous):
+        """The size, mtime and (in hash mode) sha256 of a file. The hash
+        is reused from `previous` if the size and mtime haven't changed."""
+        try: stat = os.stat(path)
+        except OSError: return None
+        entry = [stat.st_size, stat.st_mtime_ns, None]
+        if self.check != "hash": return entry
+        if previous and previous[:2] == entry[:2]:
+            entry[2] = previous[2]
+            return entry
+        digest = hashlib.sha256()
+        with open(path, "rb") as handle:
+            for block in iter(lambda: handle.read(1 << 20), b""): digest.update(block)
+        entry[2] = digest.hexdigest()
+        return entry
+
+    def _fingerprints(self, paths, previous):
+        return dict((path, self._fingerprint(path, previous.get(path))) for path in paths)
+
+    def _up_to_date(self, task, record):
+        if not record or record.get("signature") != task.signature: return False
+        outputs = self._fingerprints(task.outputs, record.get("outputs", {}))
+        if any(entry is None for entry in outputs.values()): return False
+        inputs = self._fingerprints(task.inputs, record.get("inputs", {}))
+        if any(entry is None for entry in inputs.values()):
+            raise TaskError("Missing input for task %r." % task.name)
+        if self.check == "mtime":
+            newest_input = max([entry[1] for entry in inputs.values()] or [0])
+            oldest_output = min([entry[1] for entry in outputs.values()] or [0])
+            return oldest_output >= newest_input
+        return inputs == record.get("inputs") and outputs == record.get("outputs")
+
+    #-------------------------------------------------------------------------#
+    def run(self):
+        """Run every task that isn't up to date, as many in parallel as
+        there are workers. Returns the tasks; raises a TaskError after
+        the fact if any of them failed."""
+        self._link()
+        state = self._load()
+        pending = list(self.tasks)
+        running = {}
+        while pending or running:
+            # Start every task whose dependencies are all done #
+            for task in list(pending):
+                if len(running) >= self.workers: break
+                if any(other.status is None for other in task.depends): continue
+                pending.remove(task)
+                if any(other.status in ("failed", "blocked") for other in task.depends):
+                    task.status = "blocked"
+                    continue
+                record = state.get(task.name)
+                if self._up_to_date(task, record):
+                    task.status = "skipped"
+                    continue
+                running[task] = task.command(_bg=True)
+            if not running: continue
+            done, not_done = runps.wait(list(running.values()), return_when=runps.FIRST_COMPLETED)
+            done = set(id(job) for job in done)
+            for task, job in list(running.items()):
+                if id(job) not in done: continue
+                del running[task]
+                task.result = job
+                if job.exception() is not None:
+                    task.status = "failed"
+                    state.pop(task.name, None)
+                    continue
+                task.status = "ran"
+                state[task.name] = {"signature": task.signature,
+                                    "inputs":  self._fingerprints(task.inputs, {}),
+                                    "outputs": self._fingerprints(task.outputs, {})}
+            self._save(state)
+        self._save(state)
+        failed = [task for task in self.tasks if task.status == "failed"]
+        if failed:
+            message = "%d task(s) failed, first was %r:%s"
+            raise TaskError(message % (len(failed), failed[0].name, failed[0].result.exception()))
+        return self.tasks
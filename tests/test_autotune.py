@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+# Built-in modules #
+import sys, time
+
+# Internal modules #
+import runps
+from runps.autotune import Autotuner, read_cpu_times
+
+# Third party modules #
+import pytest
+
+###############################################################################
+# Helper returning calm signals, to be overridden by each test #
+def signals(**kwargs):
+    base = {"utilization": 0.5, "load": 0.2, "cpu_pressure": 1.0, "io_pressure": 0.0,
+            "memory_pressure": 0.0, "throughput": 10.0, "running": 4, "queued": 3}
+    base.update(kwargs)
+    return base
+
+###############################################################################
+def test_scales_up_when_queuing_with_idle_cpus():
+    """Work waiting with CPUs to spare should add a slot."""
+    decisions = []
+    tuner = Autotuner(minimum=1, maximum=8, start=4, on_decision=decisions.append)
+    decision = tuner.step(signals())
+    assert (decision.old, decision.new) == (4, 5)
+    assert "queued" in decision.reason
+    assert decisions == [decision]
+    # Nothing queued or CPUs busy: hold #
+    assert tuner.step(signals(queued=0, throughput=11.0)) is None
+    assert tuner.step(signals(utilization=0.95)) is None
+    assert tuner.concurrency == 5
+
+def test_backs_off_under_pressure():
+    """Stalls or a high load should take slots away, down to the minimum."""
+    tuner = Autotuner(minimum=2, maximum=16, start=8)
+    decision = tuner.step(signals(io_pressure=40.0))
+    assert (decision.old, decision.new) == (8, 6)
+    assert "io pressure" in decision.reason
+    # Without PSI, the load average is used #
+    decision = tuner.step(signals(cpu_pressure=None, io_pressure=None, load=3.0))
+    assert decision.new == 4
+    for i in range(5): tuner.step(signals(cpu_pressure=90.0))
+    assert tuner.concurrency == 2
+
+def test_reverts_increase_that_did_not_pay_off():
+    """An increase followed by lower throughput should be undone."""
+    tuner = Autotuner(minimum=1, maximum=8, start=4)
+    assert tuner.step(signals(throughput=10.0)).new == 5
+    decision = tuner.step(signals(throughput=7.0))
+    assert decision.new == 4
+    assert "throughput" in decision.reason
+    # It waits a few steps before trying again #
+    assert tuner.step(signals()) is None
+
+def test_drives_the_process_limit():
+    """The tuner should set the limit while running and restore it after."""
+    previous = runps.limit_stats()["max_concurrent"]
+    with Autotuner(minimum=1, maximum=4, start=3, interval=0.05) as tuner:
+        assert runps.limit_stats()["max_concurrent"] == tuner.concurrency
+        python = runps.Command(sys.executable)
+        jobs = [python("-c", "pass", _bg=True) for i in range(6)]
+        runps.wait(jobs)
+        time.sleep(0.1)
+        assert 1 <= runps.limit_stats()["max_concurrent"] <= 4
+    assert runps.limit_stats()["max_concurrent"] == previous
+
+###############################################################################
+if __name__ == '__main__':
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""
+Regression tests for the import time of `runps`, using ``-X importtime``
+to find out which modules a fresh interpreter loads.
+"""
+
+# Built-in modules #
+import sys, os, subprocess
+
+# Third party modules #
+import pytest
+
+# The directory containing the `runps` package #
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+###############################################################################
+# Helper returning the names of all modules imported by a statement #
+def imported_modules(statement):
+    env = dict(os.environ, PYTHONPATH=repo_dir)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement],
+                            env=env, stderr=subprocess.PIPE, check=True)
+    lines = result.stderr.decode().splitlines()
+    return set(line.split("|")[-1].strip() for line in lines
+               if line.startswith("import time:"))
+
+###############################################################################
+def test_import_runps_is_lazy():
+    """A plain ``import runps`` should load neither `sh` nor `pbs`."""
+    modules = imported_modules("import runps")
+    assert "runps" in modules
+    assert "runps.pbs" not in modules
+    assert "sh" not in modules
+
+def test_import_command_skips_sh():
+    """Importing a pbs name should not drag the `sh` library in."""
+    modules = imported_modules("from runps import Command")
+    assert "runps.pbs" in modules
+    assert "sh" not in modules
+
+def test_import_command_skips_asyncio():
+    """Importing a pbs name should not load `asyncio`, only `asend` uses it."""
+    modules = imported_modules("from runps import Command")
+    assert "asyncio" not in modules
+
+def test_lazy_names_still_resolve():
+    """The lazily loaded names should behave as before."""
+    import runps
+    assert runps.Command is runps.self_module.Command
+    assert runps.wait is runps.self_module.wait
+    assert runps.sh is not None
+
+###############################################################################
+if __name__ == '__main__':
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""
+Memory benchmark for `Command` and `RunningCommand`, using ``tracemalloc``
+to measure what thousands of baked commands and retained results cost.
+Run this file directly to print the figures.
+"""
+
+# Built-in modules #
+import sys, gc, tracemalloc
+
+# Internal modules #
+import runps
+
+# Third party modules #
+import pytest
+
+# Access internals via the underlying module to work around SelfWrapper #
+_runps = runps.self_module
+
+###############################################################################
+# Helper returning the bytes allocated per object built by `factory` #
+def bytes_per_object(factory, count=10000):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before  = tracemalloc.get_traced_memory()[0]
+        objects = [factory() for i in range(count)]
+        after   = tracemalloc.get_traced_memory()[0]
+    finally: tracemalloc.stop()
+    assert len(objects) == count
+    return (after - before) / count
+
+###############################################################################
+def test_objects_have_no_dict():
+    """Both classes should be slotted."""
+    python = _runps.Command(sys.executable)
+    assert not hasattr(python.bake("-u"), "__dict__")
+    result = python("-c", "print(1)")
+    assert not hasattr(result, "__dict__")
+
+def test_baked_command_is_small():
+    """A child bake only pays for itself and the args it adds."""
+    base = _runps.Command(sys.executable).bake("-u", "-B", "-E", "-s")
+    size = bytes_per_object(lambda: base.bake("-c"))
+    # A dict-backed Command with copied argument lists took ~300 bytes #
+    assert size < 220
+
+def test_shared_args_cost_nothing():
+    """Bakes adding only special kwargs reuse the parent's args tuple."""
+    base  = _runps.Command(sys.executable).bake("-u", "-B", "-E", "-s")
+    child = base.bake(_cwd="/")
+    assert child._partial_baked_args is base._partial_baked_args
+    assert base.bake("-c")._partial_baked_args[-1] is sys.intern("-c")
+
+###############################################################################
+if __name__ == '__main__':
+    base = _runps.Command(sys.executable).bake("-u", "-B", "-E", "-s")
+    print("Bytes per baked command: %.0f" % bytes_per_object(lambda: base.bake("-c")))
+    print("Bytes per _cwd bake:     %.0f" % bytes_per_object(lambda: base.bake(_cwd="/")))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+# Built-in modules #
+import sys, time
+
+# Internal modules #
+import runps
+import runps.metrics
+
+# Third party modules #
+import pytest
+
+###############################################################################
+@pytest.fixture(autouse=True)
+def clean_registry():
+    runps.metrics.reset()
+    yield
+    runps.metrics.reset()
+
+def test_snapshot_counts_calls_and_exit_codes():
+    """Calls, captured bytes and exit codes should be recorded per program."""
+    python = runps.Command(sys.executable)
+    python("-c", "print('hello')")
+    python("-c", "import sys; sys.exit(2)", _ok_code=2)
+    with pytest.raises(runps.ErrorReturnCode):
+        python("-c", "import sys; sys.exit(3)")
+    python("-c", "pass", _bg=True).wait()
+    stats = runps.metrics.snapshot()[sys.executable]
+    assert stats["calls"] == 4
+    assert stats["exit_codes"] == {0: 2, 2: 1, 3: 1}
+    assert stats["errors"] == {"ErrorReturnCode_3": 1}
+    assert stats["stdout_bytes"] >= len("hello")
+    assert sum(stats["buckets"].values()) == 4
+    assert stats["seconds"] > 0
+
+def test_background_latency():
+    """Background calls should be timed until they exit, not until the wait,
+    and recorded even when nobody waits for them."""
+    python = runps.Command(sys.executable)
+    job = python("-c", "pass", _bg=True)
+    time.sleep(1)
+    job.wait()
+    assert runps.metrics.snapshot()[sys.executable]["seconds"] < 0.8
+    python("-c", "print('forgotten')", _bg=True)
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        if runps.metrics.snapshot()[sys.executable]["calls"] == 2: break
+        time.sleep(0.05)
+    assert runps.metrics.snapshot()[sys.executable]["calls"] == 2
+
+def test_compressed_sizes(monkeypatch):
+    """Compressed output should be counted without being decompressed."""
+    def fail(self, data): raise AssertionError("decompressed")
+    monkeypatch.setattr(runps.self_module.RunningCommand, "_decompress", fail)
+    python = runps.Command(sys.executable)
+    python("-c", "print('x' * 100000)", _capture_compress="zlib")
+    python("-c", "print('y' * 1000)", _capture_compress="lzma", _bg=True).exception()
+    assert runps.metrics.snapshot()[sys.executable]["stdout_bytes"] == 100001 + 1001
+
+def test_prometheus_exposition():
+    """The exposition should be in the Prometheus text format."""
+    python = runps.Command(sys.executable)
+    python("-c", "pass")
+    text = runps.metrics.exposition()
+    label = 'program="%s"' % sys.executable
+    assert "# TYPE runps_command_duration_seconds histogram" in text
+    assert 'runps_command_calls_total{%s} 1' % label in text
+    assert 'runps_command_duration_seconds_bucket{%s,le="+Inf"} 1' % label in text
+    assert 'runps_command_exit_codes_total{%s,code="0"} 1' % label in text
+
+def test_disabled():
+    """Nothing should be recorded while metrics are disabled."""
+    runps.metrics.enabled = False
+    try: runps.Command(sys.executable)("-c", "pass")
+    finally: runps.metrics.enabled = True
+    assert runps.metrics.snapshot() == {}
+
+###############################################################################
+if __name__ == '__main__':
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+# Built-in modules #
+import sys, os, io, subprocess
+
+# Internal modules #
+from runps.parallel import read_jobs, Runner, succeeded
+
+# Third party modules #
+import pytest
+
+# The directory containing the `runps` package #
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+###############################################################################
+# Helper returning the argument vector of a python one-liner #
+def python_job(code):
+    return [sys.executable, "-c", code]
+
+def log_lines(path):
+    with open(path) as handle: return [line.rstrip("\n").split("\t") for line in handle]
+
+###############################################################################
+def test_read_jobs():
+    """Lines are whole commands, or arguments for the given command."""
+    lines = ["echo 'a b' c\n", "\n", "d\n"]
+    assert read_jobs(lines) == [["echo", "a b", "c"], ["d"]]
+    assert read_jobs(["x y\n"], ["gzip", "-9"]) == [["gzip", "-9", "x y"]]
+    assert read_jobs(["x\n"], ["cp", "{}", "{}.bak"]) == [["cp", "x", "x.bak"]]
+
+def test_joblog_and_resume(tmp_path):
+    """Jobs that succeeded aren't run again with --resume."""
+    joblog = str(tmp_path / "jobs.tsv")
+    marker = str(tmp_path / "runs")
+    touch = "open(%r, 'a').write('x'); print('ok')" % marker
+    jobs = [python_job(touch), python_job("import sys; sys.exit(3)"), ["no-such-program-xyz"]]
+    out, err = io.StringIO(), io.StringIO()
+    assert Runner(jobs, workers=2, joblog=joblog, out=out, err=err).run() == 2
+    assert out.getvalue() == "ok\n"
+    assert "command not found" in err.getvalue()
+    rows = log_lines(joblog)
+    assert rows[0][0] == "Seq"
+    assert sorted((row[0], row[3], row[4]) for row in rows[1:]) == \
+        [("1", "0", "3"), ("2", "3", "0"), ("3", "127", "0")]
+    assert len(succeeded(joblog)) == 1
+    # Resuming only reruns the two failures and appends them to the log #
+    runner = Runner(jobs, workers=2, joblog=joblog, resume=True, out=out, err=err)
+    assert runner.run() == 2
+    assert runner.skipped == 1
+    assert len(log_lines(joblog)) == 6
+    with open(marker) as handle: assert handle.read() == "x"
+
+def test_command_line(tmp_path):
+    """The module runs as a script reading its jobs on stdin."""
+    env = dict(os.environ, PYTHONPATH=repo_dir)
+    command = [sys.executable, "-m", "runps.parallel", "-j", "2",
+               sys.executable, "-c", "import sys; print(sys.argv[1])"]
+    result = subprocess.run(command, input=b"a\nb\nc\n", env=env,
+                            stdout=subprocess.PIPE, check=True)
+    assert sorted(result.stdout.split()) == [b"a", b"b", b"c"]
+
+###############################################################################
+if __name__ == '__main__':
+    pytest.main([__file__, "-v"])
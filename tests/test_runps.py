@@ -2,7 +2,8 @@
 # -*- coding: utf8 -*-
 
 # Built-in modules #
-import sys, os, platform
+import sys, os, platform, threading, time, asyncio
+from concurrent import futures
 
 # Internal modules #
 import runps
@@ -354,6 +355,18 @@ def test_bake_str_shows_args():
     assert sys.executable in representation
     assert "-u" in representation
 
+def test_bake_shares_and_hashes():
+    """Bakes share their parent's args and can be used as cache keys."""
+    python = python_cmd()
+    parent = python.bake("-u")
+    child  = parent.bake(_cwd="/")
+    assert child._partial_baked_args is parent._partial_baked_args
+    assert parent == python.bake("-u")
+    assert child != parent
+    cache = {parent: 1}
+    assert cache[python.bake("-u")] == 1
+    assert hash(parent) == hash(str(parent))
+
 def test_bake_chaining(tmp_path):
     """Baking can be chained multiple times."""
     script = write_script(tmp_path, 'dump_args.py', [
@@ -406,6 +419,263 @@ def test_background_stdout(tmp_path):
     p = python(script, _bg=True)
     assert "bg output" in p.stdout
 
+def test_background_future_protocol(tmp_path):
+    """Background commands should behave like concurrent.futures.Future."""
+    script = write_script(tmp_path, 'bg_future.py', [
+        'print("future done")',
+    ])
+    python = python_cmd()
+    p = python(script, _bg=True)
+    called = []
+    p.add_done_callback(called.append)
+    assert p.result(timeout=10) is p
+    assert p.done()
+    assert p.exception() is None
+    assert called == [p]
+    assert "future done" in str(p)
+
+def test_background_future_exception(tmp_path):
+    """A failing background command should surface its ErrorReturnCode."""
+    script = write_script(tmp_path, 'bg_fail.py', [
+        'import sys',
+        'sys.exit(3)',
+    ])
+    python = python_cmd()
+    p = python(script, _bg=True)
+    assert isinstance(p.exception(timeout=10), get_rc_exc(3))
+    with pytest.raises(ErrorReturnCode):
+        p.result()
+
+def test_wait_first_completed(tmp_path):
+    """runps.wait should return as soon as the first job finishes."""
+    fast = write_script(tmp_path, 'fast.py', ['print("fast")'])
+    slow = write_script(tmp_path, 'slow.py', ['import time', 'time.sleep(5)'])
+    python = python_cmd()
+    slow_job = python(slow, _bg=True)
+    fast_job = python(fast, _bg=True)
+    done, not_done = runps.wait([slow_job, fast_job], timeout=10,
+                                return_when=runps.FIRST_COMPLETED)
+    assert done == [fast_job]
+    assert not_done == [slow_job]
+    slow_job.kill()
+
+def test_background_callback_error(tmp_path):
+    """A raising done-callback should not change the result of the job."""
+    script = write_script(tmp_path, 'bg_callback.py', ['print("ok")'])
+    python = python_cmd()
+    p = python(script, _bg=True)
+    def explode(job): raise ValueError("callback failure")
+    p.add_done_callback(explode)
+    assert p.result(timeout=10) is p
+    assert "ok" in str(p)
+
+def test_background_piping_wait(tmp_path):
+    """Waiting on a piped producer should not steal the consumer's input."""
+    producer = write_script(tmp_path, 'producer.py', [
+        'print("x" * 100000)',
+    ])
+    consumer = write_script(tmp_path, 'consumer.py', [
+        'import sys',
+        'print(len(sys.stdin.read().strip()))',
+    ])
+    python = python_cmd()
+    produced = python(producer, _bg=True)
+    consumed = python.bake(consumer)(produced)
+    runps.wait([produced, consumed], timeout=10)
+    assert int(consumed) == 100000
+    assert produced.stdout == ""
+
+def test_background_jobs_share_one_thread(tmp_path):
+    """Many background jobs should be collected without a thread per job."""
+    script = write_script(tmp_path, 'chatty.py', [
+        'import sys',
+        'sys.stdout.write("o" * 100000)',
+        'sys.stderr.write("e" * 100000)',
+    ])
+    python = python_cmd()
+    threads_before = threading.active_count()
+    jobs = [python(script, _bg=True) for i in range(50)]
+    runps.wait(jobs, timeout=30)
+    assert threading.active_count() <= threads_before + 1
+    assert all(len(job.stdout) == 100000 for job in jobs)
+    assert all(len(job.stderr) == 100000 for job in jobs)
+
+def test_background_stdin(tmp_path):
+    """The _in kwarg should also be fed to background commands."""
+    script = write_script(tmp_path, 'bg_stdin.py', [
+        'import sys',
+        'print("got: " + sys.stdin.read())',
+    ])
+    python = python_cmd()
+    p = python(script, _in="bg input", _bg=True)
+    assert "got: bg input" in p.wait()
+
+def test_wait_all_completed(tmp_path):
+    """runps.wait should by default return when every job has finished."""
+    script = write_script(tmp_path, 'job.py', ['print("job")'])
+    python = python_cmd()
+    jobs = [python(script, _bg=True) for i in range(5)]
+    done, not_done = runps.wait(jobs, timeout=10)
+    assert len(done) == 5
+    assert not not_done
+
+###############################################################################
+#                              Process limits                                 #
+###############################################################################
+@pytest.fixture
+def limits():
+    yield runps.set_limits
+    runps.set_limits(None, None)
+
+def test_max_concurrent(tmp_path, limits):
+    """No more than max_concurrent children should run at the same time."""
+    script = write_script(tmp_path, 'nap.py', ['import time', 'time.sleep(0.2)'])
+    python = python_cmd()
+    limits(max_concurrent=2)
+    start = time.monotonic()
+    jobs = []
+    for i in range(6):
+        jobs.append(python(script, _bg=True))
+        assert runps.limit_stats()["running"] <= 2
+    runps.wait(jobs, timeout=30)
+    assert time.monotonic() - start >= 0.6
+
+def test_queue_timeout(tmp_path, limits):
+    """Waiting longer than _queue_timeout for a slot should raise."""
+    script = write_script(tmp_path, 'nap.py', ['import time', 'time.sleep(1)'])
+    python = python_cmd()
+    limits(max_concurrent=1)
+    job = python(script, _bg=True)
+    with pytest.raises(runps.QueueTimeout):
+        python(script, _queue_timeout=0.1, _priority="high")
+    assert runps.limit_stats()["timeouts"] >= 1
+    job.wait()
+
+def test_max_spawns_per_sec(limits):
+    """Spawns should be spread out according to max_spawns_per_sec."""
+    python = python_cmd()
+    limits(max_spawns_per_sec=20)
+    start = time.monotonic()
+    for i in range(5): python("-c", "pass")
+    assert time.monotonic() - start >= 0.2
+    assert runps.limit_stats()["total_wait"] > 0
+
+###############################################################################
+#                               Coprocesses                                   #
+###############################################################################
+def write_doubler(tmp_path):
+    return write_script(tmp_path, 'doubler.py', [
+        'import sys',
+        'for line in sys.stdin:',
+        '    if line.strip() == "die":',
+        '        sys.stderr.write("dying")',
+        '        sys.exit(4)',
+        '    print(int(line) * 2, flush=True)',
+    ])
+
+def test_coprocess_send(tmp_path):
+    """A coprocess should answer many requests with a single child."""
+    python = python_cmd()
+    with python.coprocess(write_doubler(tmp_path)) as doubler:
+        pid = doubler.job.process.pid
+        assert doubler.send("21") == "42"
+        assert doubler.send(b"5") == b"10"
+        assert asyncio.run(doubler.asend("7")) == "14"
+        assert doubler.job.process.pid == pid
+
+def test_coprocess_death_and_restart(tmp_path):
+    """A dying coprocess should raise ErrorReturnCode_N and be restarted."""
+    python = python_cmd()
+    with python.coprocess(write_doubler(tmp_path)) as doubler:
+        with pytest.raises(get_rc_exc(4)) as exc_info:
+            doubler.send("die")
+        assert exc_info.value.stderr == b"dying"
+        assert doubler.send("1") == "2"
+        assert doubler.started == 2
+
+def test_coprocess_pool(tmp_path):
+    """A pool of coprocesses should serve parallel clients."""
+    python = python_cmd()
+    results = []
+    with python.coprocess(write_doubler(tmp_path), size=3) as pool:
+        threads = [threading.Thread(target=lambda i=i: results.append(pool.send(str(i))))
+                   for i in range(20)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+    assert sorted(int(result) for result in results) == [2 * i for i in range(20)]
+
+###############################################################################
+#                                Fan-out                                      #
+###############################################################################
+def test_fanout(tmp_path):
+    """One producer's output should reach every consumer in full."""
+    producer = write_script(tmp_path, 'produce.py', [
+        'import sys',
+        'for i in range(100000): sys.stdout.write("line %d\\n" % i)',
+    ])
+    python = python_cmd()
+    count = python.bake("-c", "import sys; print(sum(1 for line in sys.stdin))")
+    size  = python.bake("-c", "import sys; print(len(sys.stdin.buffer.read()))")
+    first = python.bake("-c", "import sys; print(sys.stdin.readline().strip())")
+    result = runps.fanout(python.bake(producer), [count, size, first])
+    assert [str(job).strip() for job in result.consumers] == ["100000", "1088890", "line 0"]
+    assert result.producer.process.returncode == 0
+
+def test_fanout_large_output(tmp_path):
+    """Consumers and producers printing more than a pipe buffer shouldn't block."""
+    python = python_cmd()
+    producer = python.bake("-c", "import sys; sys.stdout.write('x' * 2000000); sys.stderr.write('e' * 200000)")
+    copy = python.bake("-c", "import sys, shutil; shutil.copyfileobj(sys.stdin.buffer, sys.stdout.buffer)")
+    result = runps.fanout(producer, [copy, copy])
+    assert [len(job.stdout) for job in result.consumers] == [2000000, 2000000]
+    assert len(result.producer.stderr) == 200000
+
+def test_fanout_error(tmp_path):
+    """A failing consumer should raise once everything has finished."""
+    python = python_cmd()
+    producer = python.bake("-c", "print('data')")
+    failing  = python.bake("-c", "import sys; sys.stdin.read(); sys.exit(2)")
+    with pytest.raises(_runps.get_rc_exc(2)):
+        runps.fanout(producer, [failing, python.bake("-c", "pass")])
+
+###############################################################################
+#                              Python pool                                    #
+###############################################################################
+def test_python_pool(tmp_path):
+    """A pre-started interpreter should run the script like a new one."""
+    script = write_script(tmp_path, 'report.py', [
+        'import sys, os',
+        'print(sys.argv[1:], os.path.basename(os.getcwd()), os.environ.get("POOL_VAR"))',
+        'print(sys.stdin.read().upper(), __name__)',
+        'sys.exit(int(sys.argv[1]))',
+    ])
+    expected = "['0'] %s set\nDATA __main__\n" % os.path.basename(str(tmp_path))
+    with _runps.PythonPool(size=1) as pool:
+        result = pool(script, 0, _cwd=str(tmp_path), _env_update={"POOL_VAR": "set"}, _in="data")
+        assert str(result) == expected
+        with pytest.raises(_runps.get_rc_exc(3)):
+            pool(script, 3, _cwd=str(tmp_path))
+        assert pool.hits + pool.fallbacks == 2
+
+def test_python_pool_fallback(tmp_path):
+    """Calls a worker can't honour should spawn a real interpreter."""
+    with _runps.PythonPool(size=1) as pool:
+        assert str(pool("-u", "-c", "print('spawned')")) == "spawned\n"
+        assert str(pool("-c", "print(1)", _env_update={"PYTHONHASHSEED": "1"})) == "1\n"
+        assert pool.fallbacks == 2
+        assert pool.hits == 0
+
+def test_python_pool_queue_timeout(limits):
+    """A call timing out in the queue should leave its worker in the pool."""
+    limits(max_concurrent=1)
+    blocker = python_cmd()("-c", "import time; time.sleep(0.5)", _bg=True)
+    with _runps.PythonPool(size=1) as pool:
+        with pytest.raises(runps.QueueTimeout):
+            pool("-c", "print(1)", _queue_timeout=0.05)
+        blocker.wait()
+        assert str(pool("-c", "print(2)", _queue_timeout=5)) == "2\n"
+        assert pool.hits == 1
+
 ###############################################################################
 #                         Foreground processes                                #
 ###############################################################################
@@ -539,6 +809,154 @@ def test_running_command_equality(tmp_path):
     r2 = python(script)
     assert r1 == r2
 
+###############################################################################
+#                              JSON output                                    #
+###############################################################################
+def test_json_output(tmp_path):
+    """The .json() method should parse the whole output as JSON."""
+    script = write_script(tmp_path, 'emit_json.py', [
+        'import json',
+        'print(json.dumps({"name": "caf\u00e9", "items": [1, 2, 3]}))',
+    ])
+    python = python_cmd()
+    assert python(script).json() == {"name": "café", "items": [1, 2, 3]}
+    # Redirected output can't be parsed #
+    with pytest.raises(ValueError, match="redirected"):
+        python(script, _out=str(tmp_path / 'out.json')).json()
+
+def test_iter_json_streaming(tmp_path):
+    """The .iter_json() method should stream NDJSON from a background job."""
+    script = write_script(tmp_path, 'emit_ndjson.py', [
+        'import json, sys',
+        'for i in range(100000): print(json.dumps({"i": i}))',
+        'sys.stderr.write("e" * 100000)',
+    ])
+    python = python_cmd()
+    p = python(script, _bg=True)
+    total = 0
+    for count, item in enumerate(p.iter_json()):
+        assert item == {"i": count}
+        total += 1
+    assert total == 100000
+    assert len(p.stderr) == 100000
+
+def test_iter_json_finished(tmp_path):
+    """The .iter_json() method should also work on a finished command."""
+    script = write_script(tmp_path, 'emit_ndjson.py', [
+        'print(\'{"a": 1}\')',
+        'print()',
+        'print(\'{"b": 2}\')',
+    ])
+    python = python_cmd()
+    assert list(python(script).iter_json()) == [{"a": 1}, {"b": 2}]
+
+###############################################################################
+#                             Numeric output                                  #
+###############################################################################
+def test_to_array(tmp_path):
+    """The .to_array() method should parse numbers into an array.array."""
+    import array
+    script = write_script(tmp_path, 'table.py', [
+        'for i in range(5): print(i, i * 1.5, "name", sep=",")',
+    ])
+    python = python_cmd()
+    result = python(script)
+    first, second = result.to_array("d", columns=[0, 1], sep=",", use_numpy=False)
+    assert first == array.array("d", [0, 1, 2, 3, 4])
+    assert second == array.array("d", [0, 1.5, 3, 4.5, 6])
+    assert result.to_array("l", columns=0, sep=",", use_numpy=False).tolist() == [0, 1, 2, 3, 4]
+    flat = python("-c", "print(*range(10)); print(10, 11)").to_array("q", use_numpy=False)
+    assert flat == array.array("q", range(12))
+
+def test_iter_arrays(tmp_path):
+    """The .iter_arrays() method should yield one array per batch of lines."""
+    python = python_cmd()
+    job = python("-c", "for i in range(10): print(i)", _bg=True)
+    batches = [list(batch) for batch in job.iter_arrays("l", lines=4, use_numpy=False)]
+    assert batches == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+
+def test_to_array_numpy():
+    """With NumPy installed, .to_array() should return NumPy arrays."""
+    numpy = pytest.importorskip("numpy")
+    python = python_cmd()
+    result = python("-c", "print('1 2'); print('3 4')")
+    assert isinstance(result.to_array(), numpy.ndarray)
+    assert result.to_array("d", columns=1).tolist() == [2.0, 4.0]
+
+###############################################################################
+#                          Shared memory output                               #
+###############################################################################
+def share_output(size):
+    python = runps.Command(sys.executable)
+    return python("-c", "import sys; print('x' * %d); sys.stderr.write('err')" % size).share()
+
+def test_share_pickles_by_name():
+    """A shared result should travel as a name and read back the output."""
+    import pickle
+    shared = share_output(100000)
+    payload = pickle.dumps(shared)
+    assert len(payload) < 1000
+    with pickle.loads(payload) as other:
+        assert other.stdout == "x" * 100000 + os.linesep
+        assert other.stderr == "err"
+        assert other.stdout_view.readonly
+        assert bytes(other.stdout_view[:3]) == b"xxx"
+    shared.close()
+    with pytest.raises(FileNotFoundError):
+        pickle.loads(payload).stdout
+
+def test_share_from_worker_process():
+    """The segment should outlive the worker process that made it."""
+    import multiprocessing
+    with multiprocessing.Pool(1) as pool: shared = pool.apply(share_output, (10,))
+    with shared: assert shared.stdout.strip() == "x" * 10
+
+###############################################################################
+#                          Compressed capture                                 #
+###############################################################################
+@pytest.mark.parametrize("codec", ["zlib", "lzma"])
+def test_capture_compress(tmp_path, codec):
+    """Output kept with _capture_compress should read back unchanged."""
+    script = write_script(tmp_path, 'verbose.py', [
+        'import sys',
+        'for i in range(20000): print("warning: unused variable", i % 7)',
+        'sys.stderr.write("error\\n" * 500)',
+    ])
+    python = python_cmd()
+    plain = python(script)
+    for job in (python(script, _capture_compress=codec),
+                python(script, _capture_compress=codec, _bg=True)):
+        assert job.stdout == plain.stdout
+        assert job.stderr == plain.stderr
+        assert len(job._stdout) < len(plain._stdout) // 10
+
+def test_capture_compress_errors(tmp_path):
+    """Exceptions should carry the decompressed output."""
+    python = python_cmd()
+    with pytest.raises(ErrorReturnCode) as info:
+        python("-c", "import sys; print('x' * 100); sys.exit(3)", _capture_compress="zlib")
+    assert info.value.stdout == b"x" * 100 + os.linesep.encode()
+    with pytest.raises(ValueError):
+        python("-c", "pass", _capture_compress="gzip")
+
+###############################################################################
+#                            Output filtering                                 #
+###############################################################################
+def test_filter_regex_and_callable(tmp_path):
+    """_filter should keep only the matching lines and count the others."""
+    script = write_script(tmp_path, 'noisy.py', [
+        'for i in range(5000): print("warning: %d" % i if i % 100 == 0 else "noise")',
+        'print("last warning: no newline", end="")',
+    ])
+    python = python_cmd()
+    for pattern in ("^warning:", lambda line: line.startswith("warning:")):
+        result = python(script, _filter=pattern)
+        assert result.stdout.splitlines() == ["warning: %d" % i for i in range(0, 5000, 100)]
+        assert result.dropped_lines == 4951
+    job = python(script, _filter="warning", _bg=True)
+    assert job.stdout.endswith("last warning: no newline")
+    assert job.dropped_lines == 4950
+
 ###############################################################################
 #                              Stdin via _in                                  #
 ###############################################################################
@@ -553,6 +971,26 @@ def test_stdin_input(tmp_path):
     result = python(script, _in="hello from stdin")
     assert "got: hello from stdin" in str(result)
 
+def test_stdin_from_file(tmp_path):
+    """_in should also take a path, an open file or a descriptor."""
+    import pathlib
+    script = write_script(tmp_path, 'read_stdin.py', [
+        'import sys',
+        'print("got: " + sys.stdin.read().strip())',
+    ])
+    data = str(tmp_path) + os.sep + 'data.txt'
+    with open(data, 'w') as handle: handle.write('from a file\n')
+    python = python_cmd()
+    assert "got: from a file" in str(python(script, _in_path=data))
+    assert "got: from a file" in str(python(script, _in=pathlib.Path(data)))
+    with open(data, 'rb') as handle:
+        assert "got: from a file" in str(python(script, _in=handle))
+    fd = os.open(data, os.O_RDONLY)
+    try: assert "got: from a file" in python(script, _in=fd, _bg=True).wait()
+    finally: os.close(fd)
+    # A plain string is still text to feed, not a path #
+    assert "got: " + data in str(python(script, _in=data))
+
 ###############################################################################
 #                         Working directory (_cwd)                            #
 ###############################################################################
@@ -608,6 +1046,48 @@ def test_piping(tmp_path):
     result = consumer_cmd(produced)
     assert "received: piped data" in str(result)
 
+def test_pipeline(tmp_path):
+    """Stages built with | run together and report every exit code."""
+    python = python_cmd()
+    produce = python.bake("-c", "for i in range(1000): print(i)")
+    upper   = python.bake("-c", "import sys; sys.stdout.write(sys.stdin.read().upper())")
+    count   = python.bake("-c", "import sys; print(sum(1 for line in sys.stdin))")
+    pipeline = produce | upper | count
+    assert isinstance(pipeline, _runps.Pipeline)
+    result = pipeline()
+    assert str(result).strip() == "1000"
+    assert result.exit_codes == [0, 0, 0]
+    stats = result.stats
+    assert [stat["exit_code"] for stat in stats] == [0, 0, 0]
+    assert all(stat["wall"] >= 0 for stat in stats)
+
+def test_pipeline_pipefail(tmp_path):
+    """A failing stage fails the pipeline unless _pipefail is False."""
+    python = python_cmd()
+    failing = python.bake("-c", "import sys; print(1); sys.exit(4)")
+    count   = python.bake("-c", "import sys; print(sum(1 for line in sys.stdin))")
+    with pytest.raises(_runps.get_rc_exc(4)):
+        (failing | count)()
+    result = (failing | count)(_pipefail=False)
+    assert result.exit_codes == [4, 0]
+    assert str(result).strip() == "1"
+
+def test_pipeline_under_limits(limits):
+    """A pipeline with more stages than the limit shouldn't deadlock, and
+    neither should a fanout to more consumers than it."""
+    python = python_cmd()
+    produce = python.bake("-c", "import sys; sys.stdout.write('x' * 1000000)")
+    copy    = python.bake("-c", "import sys, shutil; shutil.copyfileobj(sys.stdin.buffer, sys.stdout.buffer)")
+    size    = python.bake("-c", "import sys; print(len(sys.stdin.buffer.read()))")
+    limits(max_concurrent=2)
+    result = (produce | copy | size)()
+    assert str(result).strip() == "1000000"
+    result = runps.fanout(produce, [size, size])
+    assert [str(job).strip() for job in result.consumers] == ["1000000"] * 2
+    wait_for = time.monotonic() + 5
+    while runps.limit_stats()["running"] and time.monotonic() < wait_for: time.sleep(0.01)
+    assert runps.limit_stats()["running"] == 0
+
 ###############################################################################
 #                             Environment                                     #
 ###############################################################################
@@ -623,6 +1103,211 @@ def test_custom_env(tmp_path):
     result = python(script, _env=env)
     assert "custom_value" in str(result)
 
+def test_env_update_and_remove(tmp_path):
+    """The _env_update and _env_remove kwargs should overlay os.environ."""
+    script = write_script(tmp_path, 'env_overlay.py', [
+        'import os',
+        'print(os.environ.get("MY_TEST_VAR"), "HOME" in os.environ)',
+    ])
+    python = python_cmd()
+    result = python(script, _env_update={"MY_TEST_VAR": 1}, _env_remove=["HOME"])
+    assert str(result).strip() == "1 False"
+    assert "MY_TEST_VAR" not in os.environ
+
+def test_env_template_follows_base(tmp_path):
+    """An EnvTemplate should be reused until its base mapping changes."""
+    script = write_script(tmp_path, 'env_template.py', [
+        'import os',
+        'print(os.environ.get("BASE_VAR"), os.environ.get("EXTRA_VAR"))',
+    ])
+    python = python_cmd()
+    base = {"BASE_VAR": "a"}
+    env = runps.EnvTemplate(base, update={"EXTRA_VAR": "b"})
+    assert env.get() is env.get()
+    assert str(python(script, _env=env)).strip() == "a b"
+    base["BASE_VAR"] = "c"
+    assert str(python(script, _env=env)).strip() == "c b"
+
+###############################################################################
+#                               Hedging                                       #
+###############################################################################
+def test_hedge_after(tmp_path):
+    """A slow first run should be raced by a duplicate that wins."""
+    flag = str(tmp_path / 'flag')
+    script = write_script(tmp_path, 'probe.py', [
+        'import os, sys, time',
+        'if not os.path.exists(sys.argv[1]):',
+        '    open(sys.argv[1], "w").close()',
+        '    time.sleep(5)',
+        'print("probed")',
+    ])
+    python = python_cmd()
+    before = runps.hedge_stats()
+    killed = runps.metrics.snapshot().get(python._path, {}).get("exit_codes", {}).get(-9, 0)
+    start = time.monotonic()
+    result = python(script, flag, _hedge_after=0.2)
+    assert str(result) == "probed\n"
+    assert time.monotonic() - start < 4
+    after = runps.hedge_stats()
+    assert after["calls"] == before["calls"] + 1
+    assert after["fired"] == before["fired"] + 1
+    assert after["won"] == before["won"] + 1
+    # The killed loser isn't counted as a failed call #
+    time.sleep(0.5)
+    assert runps.metrics.snapshot()[python._path]["exit_codes"].get(-9, 0) == killed
+    # Fast runs don't fire, and errors are raised as usual #
+    assert str(python(script, flag, _hedge_after=5)) == "probed\n"
+    assert runps.hedge_stats()["fired"] == after["fired"]
+    with pytest.raises(_runps.get_rc_exc(2)):
+        python("-c", "import sys; sys.exit(2)", _hedge_after="p95")
+
+###############################################################################
+#                              Coalescing                                     #
+###############################################################################
+def test_coalesce(tmp_path):
+    """Identical concurrent calls should share one process and its result."""
+    log = str(tmp_path / 'runs')
+    script = write_script(tmp_path, 'count.py', [
+        'import sys, time',
+        'open(sys.argv[1], "a").write("run\\n")',
+        'time.sleep(0.5)',
+        'if sys.argv[2] == "fail": sys.exit(3)',
+        'print("counted")',
+    ])
+    python = python_cmd()
+    def call(mode):
+        try: return python(script, log, mode, _coalesce=True)
+        except Exception as error: return error
+    with futures.ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(call, ["ok"] * 4))
+    assert all(result is results[0] for result in results)
+    assert str(results[0]) == "counted\n"
+    assert open(log).read() == "run\n"
+    # Errors are shared too, and nothing is kept once the call finished #
+    with futures.ThreadPoolExecutor(3) as pool:
+        errors = list(pool.map(call, ["fail"] * 3))
+    assert isinstance(errors[0], _runps.get_rc_exc(3))
+    assert all(error is errors[0] for error in errors)
+    assert not _runps._flights
+    python(script, log, "ok", _coalesce=True)
+    assert open(log).read().count("run") == 3
+
+def test_coalesce_baked():
+    """A baked _coalesce should coalesce too, not wait on itself."""
+    python = python_cmd().bake(_coalesce=True)
+    result = []
+    thread = threading.Thread(target=lambda: result.append(str(python("-c", "print(1)"))))
+    thread.daemon = True
+    thread.start()
+    thread.join(10)
+    assert result == ["1\n"]
+    assert not _runps._flights
+
+###############################################################################
+#                           Resource sampling                                 #
+###############################################################################
+@pytest.mark.skipif(not os.path.isdir("/proc"), reason="needs /proc")
+def test_sample_interval(tmp_path):
+    """_sample_interval should record a time series while the child runs."""
+    script = write_script(tmp_path, 'grow.py', [
+        'import time',
+        'data = bytearray(64 * 1024 * 1024)',
+        'time.sleep(0.4)',
+    ])
+    python = python_cmd()
+    result = python(script, _sample_interval=0.05)
+    samples = result.samples
+    assert len(samples) >= 3
+    assert samples.peak_rss > 64 * 1024 * 1024
+    assert list(samples.time) == sorted(samples.time)
+    assert len(next(iter(samples))) == 5
+    assert python(script).samples is None
+
+@pytest.mark.skipif(not os.path.isdir("/proc"), reason="needs /proc")
+def test_sample_children(tmp_path):
+    """_sample_children should include the memory of descendants."""
+    child = write_script(tmp_path, 'child.py', [
+        'import time',
+        'data = bytearray(64 * 1024 * 1024)',
+        'time.sleep(0.4)',
+    ])
+    parent = write_script(tmp_path, 'parent.py', [
+        'import sys, subprocess',
+        'subprocess.run([sys.executable, sys.argv[1]])',
+    ])
+    python = python_cmd()
+    result = python(parent, child, _sample_interval=0.05, _sample_children=True, _bg=True)
+    result.wait()
+    assert result.samples.peak_rss > 64 * 1024 * 1024
+
+###############################################################################
+#                           Resource controls                                 #
+###############################################################################
+@pytest.mark.skipif(os.name == 'nt', reason="POSIX only")
+def test_nice_and_rlimits(tmp_path):
+    """The _nice and _rlimits kwargs should apply to the child only."""
+    script = write_script(tmp_path, 'limits.py', [
+        'import os, resource',
+        'print(os.nice(0), resource.getrlimit(resource.RLIMIT_NOFILE)[0])',
+    ])
+    python = python_cmd().bake(_nice=5, _rlimits={"nofile": 64})
+    niceness, nofile = str(python(script)).split()
+    assert int(niceness) == os.nice(0) + 5
+    assert int(nofile) == 64
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason="Linux only")
+def test_cpu_affinity_and_ionice(tmp_path):
+    """The _cpu_affinity and _ionice kwargs should apply to the child."""
+    script = write_script(tmp_path, 'affinity.py', [
+        'import os',
+        'print(sorted(os.sched_getaffinity(0)))',
+    ])
+    python = python_cmd()
+    result = python(script, _cpu_affinity=[0], _ionice="idle")
+    assert str(result).strip() == "[0]"
+
+@pytest.mark.skipif(os.name == 'nt', reason="POSIX only")
+def test_unwritable_cgroup_warns(tmp_path):
+    """A _cgroup_path we can't write to should be skipped with a warning."""
+    python = python_cmd()
+    with pytest.warns(UserWarning):
+        python("-c", "pass", _cgroup_path=str(tmp_path / "missing"))
+
+###############################################################################
+#                             Record / replay                                 #
+###############################################################################
+def test_record_then_replay(tmp_path):
+    """Replayed calls should return the recorded results without spawning."""
+    script = write_script(tmp_path, 'recorded.py', [
+        'import sys',
+        'print("recorded " + sys.argv[1])',
+        'sys.exit(int(sys.argv[2]))',
+    ])
+    fixture = str(tmp_path / 'calls.json')
+    python = python_cmd()
+    with runps.record(fixture):
+        python(script, "ok", 0)
+        with pytest.raises(get_rc_exc(3)): python(script, "bad", 3)
+    os.remove(script)
+    with runps.replay(fixture):
+        assert str(python(script, "ok", 0)) == "recorded ok\n"
+        with pytest.raises(get_rc_exc(3)) as exc_info: python(script, "bad", 3)
+        assert b"recorded bad" in exc_info.value.stdout
+
+def test_replay_strict_and_lenient(tmp_path):
+    """Strict replay should reject unmatched calls, lenient replay reuses."""
+    fixture = str(tmp_path / 'calls.json')
+    python = python_cmd()
+    with runps.record(fixture):
+        python("-c", "print('bg')", _bg=True)
+    with runps.replay(fixture):
+        assert "bg" in python("-c", "print('bg')", _bg=True).wait()
+        with pytest.raises(runps.ReplayError):
+            python("-c", "print('bg')", _bg=True)
+    with runps.replay(fixture, strict=False):
+        for i in range(2):
+            assert "bg" in str(python("-c", "print('bg')", _cwd=str(tmp_path)))
+
 ###############################################################################
 #                          Unicode / encoding                                 #
 ###############################################################################
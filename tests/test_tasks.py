@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+# Built-in modules #
+import sys, os, time
+
+# Internal modules #
+import runps
+from runps.tasks import TaskGraph, TaskError
+
+# Third party modules #
+import pytest
+
+###############################################################################
+# A script that concatenates its inputs into its output and logs each run #
+def write_concat(tmp_path):
+    path = str(tmp_path / 'concat.py')
+    with open(path, 'w') as handle:
+        handle.write('import sys\n'
+                     'out, log, inputs = sys.argv[1], sys.argv[2], sys.argv[3:]\n'
+                     'data = "".join(open(path).read() for path in inputs)\n'
+                     'open(out, "w").write(data)\n'
+                     'open(log, "a").write(out + "\\n")\n')
+    return path
+
+def build_graph(tmp_path, check):
+    concat = runps.Command(sys.executable).bake(write_concat(tmp_path))
+    path = lambda name: str(tmp_path / name)
+    graph = TaskGraph(state=path('state.json'), workers=2, check=check)
+    graph.add(concat, path('ab'), path('log'), path('a'), path('b'),
+              inputs=[path('a'), path('b')], outputs=[path('ab')], name="ab")
+    graph.add(concat, path('cd'), path('log'), path('c'), path('d'),
+              inputs=[path('c'), path('d')], outputs=[path('cd')], name="cd")
+    graph.add(concat, path('all'), path('log'), path('ab'), path('cd'),
+              inputs=[path('ab'), path('cd')], outputs=[path('all')], name="all")
+    return graph
+
+def runs(tmp_path):
+    with open(str(tmp_path / 'log')) as handle:
+        return [os.path.basename(line.strip()) for line in handle]
+
+###############################################################################
+@pytest.mark.parametrize("check", ["mtime", "hash"])
+def test_incremental_run(tmp_path, check):
+    """Tasks should run in dependency order, then only when stale."""
+    for name in "abcd":
+        with open(str(tmp_path / name), 'w') as handle: handle.write(name)
+    build_graph(tmp_path, check).run()
+    assert sorted(runs(tmp_path)[:2]) == ["ab", "cd"]
+    assert runs(tmp_path)[2] == "all"
+    with open(str(tmp_path / 'all')) as handle: assert handle.read() == "abcd"
+    # Nothing changed: nothing runs #
+    tasks = build_graph(tmp_path, check).run()
+    assert [task.status for task in tasks] == ["skipped"] * 3
+    assert len(runs(tmp_path)) == 3
+    # Change one input: only its chain runs again #
+    time.sleep(0.01)
+    with open(str(tmp_path / 'c'), 'w') as handle: handle.write("C")
+    build_graph(tmp_path, check).run()
+    assert runs(tmp_path)[3:] == ["cd", "all"]
+
+def test_failed_task_blocks_dependents(tmp_path):
+    """A failing task should block the tasks depending on it."""
+    python = runps.Command(sys.executable)
+    graph = TaskGraph(state=str(tmp_path / 'state.json'))
+    out = str(tmp_path / 'out')
+    graph.add(python, "-c", "import sys; sys.exit(1)", outputs=[out], name="fail")
+    graph.add(python, "-c", "pass", inputs=[out], name="after")
+    with pytest.raises(TaskError):
+        graph.run()
+    assert [task.status for task in graph.tasks] == ["failed", "blocked"]
+
+def test_cycle_detection(tmp_path):
+    """Cyclic dependencies should be refused."""
+    python = runps.Command(sys.executable)
+    graph = TaskGraph(state=str(tmp_path / 'state.json'))
+    graph.add(python, "-c", "pass", inputs=["x"], outputs=["y"], name="one")
+    graph.add(python, "-c", "pass", inputs=["y"], outputs=["x"], name="two")
+    with pytest.raises(ValueError):
+        graph.run()
+
+###############################################################################
+if __name__ == '__main__':
+    pytest.main([__file__, "-v"])